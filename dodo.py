@@ -232,14 +232,38 @@ def get_task_texture(mode, masktype, case, scan, lesion, slices, portion,
         }
 
 
+def get_task_textures(mode, masktype, case, scan, lesion, slices, portion,
+                      voxels):
+    """Generate all texture features into single file per case/scan/lesion
+    and voxel output.
+    """
+    paths = dwi.paths.Paths(mode)
+    inpath = paths.pmap(case=case, scan=scan)
+    deps = [inpath]
+    mask = paths.mask(masktype, case, scan, lesion=lesion)
+    if mask is not None:
+        deps.append(mask)
+    tspecs = list(texture_methods_winsizes(mode, masktype))
+    outfiles = [paths.texture(case, scan, lesion, masktype+'_merged', slices,
+                              portion, None, voxel=x) for x in voxels]
+    cmd = dwi.shell.get_textures(mode, inpath, tspecs, slices, portion,
+                                 outfiles, voxels, mask=mask)
+    return {
+        'name': taskname(mode, masktype, slices, portion, case, scan, lesion),
+        'actions': folders(*outfiles) + [cmd],
+        'file_dep': _files(*deps),
+        'targets': _files(*outfiles),
+        'clean': True,
+        }
+
+
 def task_texture():
     """Generate texture features."""
     for mode, sl in product(MODES, SAMPLELISTS):
-        for mt, slices, portion, voxel in texture_params():
+        for mt, slices, portion, voxels in texture_params():
             for c, s, l in lesions(mode, sl):
-                for tspec in texture_methods_winsizes(mode, mt):
-                    yield get_task_texture(mode, mt, c, s, l, slices, portion,
-                                           tspec, voxel)
+                yield get_task_textures(mode, mt, c, s, l, slices, portion,
+                                        voxels)
         mt = 'prostate'
         for c, s in cases_scans(mode, sl):
             for tspec in texture_methods_winsizes(mode, mt):
@@ -254,41 +278,8 @@ def task_texture():
                                        'all')
         for mt in ['CA', 'N']:
             for c, s in cases_scans(mode, sl):
-                for tspec in texture_methods_winsizes(mode, mt):
-                    yield get_task_texture(mode, mt, c, s, None, 'all', 0,
-                                           tspec, 'median')
-
-
-def get_task_merge_textures(mode, mt, c, s, l, slices, portion, voxel):
-    """Merge texture methods into singe file per case/scan/lesion."""
-    paths = dwi.paths.Paths(mode)
-    infiles = [paths.texture(c, s, l, mt, slices, portion, tspec, voxel=voxel)
-               for tspec in texture_methods_winsizes(mode, mt)]
-    outfile = paths.texture(c, s, l, mt+'_merged', slices, portion, None,
-                            voxel=voxel)
-    cmd = dwi.shell.select_voxels(' '.join(map(str, infiles)), outfile)
-    return {
-        'name': taskname(mode, c, s, l, mt, slices, portion,
-                         voxel),
-        'actions': folders(outfile) + [cmd],
-        'file_dep': _files(*infiles),
-        'targets': _files(outfile),
-        }
-
-
-def task_merge_textures():
-    """Merge texture methods into singe file per case/scan/lesion."""
-    for mode, sl in product(MODES, SAMPLELISTS):
-        for mt, slices, portion, voxel in texture_params(voxels=['mean',
-                                                                 'median']):
-            for c, s, l in lesions(mode, sl):
-                yield get_task_merge_textures(mode, mt, c, s, l, slices,
-                                              portion, voxel)
-        for mt in ['CA', 'N']:
-            slices, portion, voxel, l = 'all', 0, 'median', None
-            for c, s in cases_scans(mode, sl):
-                yield get_task_merge_textures(mode, mt, c, s, l, slices,
-                                              portion, voxel)
+                yield get_task_textures(mode, mt, c, s, None, 'all', 0,
+                                        ['median'])
 
 
 def get_task_histogram(mode, masktype, samplelist):
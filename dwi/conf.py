@@ -93,6 +93,19 @@ def get_config_parser():
     p.add('--maxjobs', type=float, default=0.9,
           help=('maximum number of simultaneous jobs '
                 '(absolute, portion of CPU count, or negative count)'))
+    p.add('--tilejobs', type=float, default=1,
+          help=('number of processes for tiled calculation within a job '
+                '(absolute, portion of CPU count, or negative count)'))
+    p.add('--tilesize', type=int, default=64,
+          help='tile side length for tiled calculation')
+    p.add('--dicomjobs', type=float, default=1,
+          help=('number of workers for reading DICOM files '
+                '(absolute, portion of CPU count, or negative count)'))
+    p.add('--dicompool', choices=('threads', 'processes'), default='threads',
+          help='worker pool type for reading DICOM files')
+    p.add('--pmapcache_size', type=float, default=0,
+          help=('size limit in megabytes of the cache of images converted '
+                'from DICOM, under cachedir (0 disables)'))
     p.add('--modes', nargs='+', type=ImageMode,
           default=[ImageMode('DWI-Mono-ADCm')],
           help='image modes')
@@ -130,6 +143,13 @@ def get_config_parser():
     p.add('--texture_path', type=expanded_path,
           default=None,
           help='write result directly to disk, if string')
+    p.add('--texture_approx_winsize', type=int,
+          default=0,
+          help=('approximate windows larger than this at reduced resolution '
+                '(0 disables)'))
+    p.add('--texture_approx_samples', type=int,
+          default=64,
+          help='number of voxels to measure approximation error at')
     p.add('--texture_dtype',
           default='float32',
           help='output texture map type')
@@ -1,24 +1,43 @@
 """Support for reading multi-slice DICOM images.
 
-Use read() to read a directory, read_files() to read a group of files. Each
-DICOM file may contain one slice, otherwise it will be ignored. Reading fails
+Use read() to read a directory, read_files() to read a group of files, and
+read_zip() to read a ZIP archive without extracting it. Each DICOM file may
+contain one slice, otherwise it will be ignored. Reading fails
 unless all slices have equal orientation, shape, and pixel datatype. In case
 any slices overlap, only one of them is kept. Between-slice spacing is
 calculated from the first two slices' positional difference, as the
 corresponding data field cannot be trusted.
 """
 
+import io
 import logging
 import re
+import threading
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
 
 import numpy as np
 import pydicom
+import pydicom.filereader
 
+from .conf import rcParams
 from .types import Path
-from . import util
+from . import job, util
 
 log = logging.getLogger(__name__)
 
+# Increment when the read result changes, to invalidate converted images
+# cached by pmapcache.
+READER_VERSION = 1
+# Pixel data tag, and the tags of float and double float pixel data, where
+# header reading stops.
+PIXEL_DATA = 0x7fe00010
+PIXEL_DATA_TAGS = (0x7fe00008, 0x7fe00009, PIXEL_DATA)
+# ZIP archives kept open by open_archives() in each thread.
+_archives = threading.local()
+
 
 def read(path):
     """Read a directory containing DICOM files. See dicomfile.read_files()."""
@@ -44,23 +63,158 @@ def read(path):
     return read_files(entries)
 
 
-def read_files(paths):
+class ZipMember(namedtuple('ZipMember', ['archive', 'name'])):
+    """A file in a ZIP archive, usable in place of a DICOM file path."""
+    __slots__ = ()
+
+    def __str__(self):
+        return '{}:{}'.format(self.archive, self.name)
+
+
+def read_zip(archive, n_jobs=None, pool=None):
+    """Read a ZIP archive containing DICOM files, like a directory with read().
+    See dicomfile.read_files().
+
+    Nothing is extracted: the members are streamed from the archive into the
+    DICOM parser, and only their headers are read in the first phase.
+    """
+    archive = Path(archive)
+    with open_archives():
+        with _zipfile(archive) as z:
+            names = zip_members(z.namelist())
+        if not names:
+            raise ValueError('DICOM files not found: {}'.format(archive))
+        return read_files([ZipMember(archive, x) for x in names],
+                          n_jobs=n_jobs, pool=pool)
+
+
+def zip_members(names):
+    """Choose the files from ZIP archive member names like read() does from
+    a directory: descend into a single subdirectory or a 'DICOM' subdirectory,
+    and take the files there.
+    """
+    def children(prefix):
+        """Return the files and the subdirectories directly under prefix."""
+        files, dirs = [], []
+        for name in names:
+            if name.startswith(prefix) and name != prefix:
+                head, sep, _ = name[len(prefix):].partition('/')
+                if sep:
+                    dirs.append(prefix + head + sep)
+                else:
+                    files.append(name)
+        return files, sorted(set(dirs))
+
+    prefix = ''
+    files, dirs = children(prefix)
+    while not files and len(dirs) == 1:
+        prefix, = dirs
+        files, dirs = children(prefix)
+    if prefix + 'DICOM/' in dirs:
+        files, _ = children(prefix + 'DICOM/')
+    return files
+
+
+@contextmanager
+def open_archives():
+    """Keep the ZIP archives opened for reading members in this thread open
+    until the context exits, and close them then. Without this context, each
+    member read opens and closes its archive.
+    """
+    if getattr(_archives, 'open', None) is not None:
+        yield  # Nested, the outermost context closes them.
+        return
+    _archives.open = {}
+    try:
+        yield
+    finally:
+        archives, _archives.open = _archives.open, None
+        for z in archives.values():
+            z.close()
+
+
+@contextmanager
+def _zipfile(archive):
+    """Open a ZIP archive for reading its members, see open_archives()."""
+    archives = getattr(_archives, 'open', None)
+    if archives is None:
+        with zipfile.ZipFile(str(archive), 'r') as z:
+            yield z
+        return
+    archive = str(archive)
+    if archive not in archives:
+        archives[archive] = zipfile.ZipFile(archive, 'r')
+    yield archives[archive]
+
+
+def dcmread(path):
+    """Read a DICOM file, which may be a ZipMember. A member is read into
+    memory at once.
+    """
+    if isinstance(path, ZipMember):
+        with _zipfile(path.archive) as z:
+            f = io.BytesIO(z.read(path.name))
+        return pydicom.dcmread(f)
+    return pydicom.dcmread(str(path))
+
+
+def dcmread_header(path):
+    """Read a DICOM file, which may be a ZipMember, up to its pixel data
+    without reading that. A member is streamed from the archive. Return the
+    dataset, and whether it has pixel data.
+    """
+    stops = []
+
+    def at_pixel_data(tag, vr, length):
+        """Stop where pydicom.dcmread(stop_before_pixels=True) would."""
+        if tag in PIXEL_DATA_TAGS:
+            stops.append(tag)
+            return True
+        return False
+
+    if isinstance(path, ZipMember):
+        with _zipfile(path.archive) as z, z.open(path.name) as f:
+            df = pydicom.filereader.read_partial(f, stop_when=at_pixel_data)
+    else:
+        with open(str(path), 'rb') as f:
+            df = pydicom.filereader.read_partial(f, stop_when=at_pixel_data)
+    return df, PIXEL_DATA in stops
+
+
+def read_files(paths, n_jobs=None, pool=None):
     """Read a bunch of files, each containing a single slice with one b-value,
     and construct a 4d image array.
 
     The slices are sorted simply by their position as it is, assuming it only
     changes in one dimension. In case there are more than one scan of
-    a position and a b-value, the files are averaged by mean.
+    a position and a b-value, only the last one is kept.
+
+    Reading is done in two phases: first only the headers are read to find
+    out the slices and the image shape (see read_header()), then pixel data
+    is decoded directly into the image (see construct_image()).
 
-    DICOM files without pixel data are silently skipped.
+    Files are read by `n_jobs` workers (by default rcParams.dicomjobs) in a
+    pool of 'threads' or 'processes' (by default rcParams.dicompool). Results
+    are handled in the order of paths, independent of completion order.
+
+    DICOM files without image data are silently skipped.
     """
+    if n_jobs is None:
+        n_jobs = rcParams.dicomjobs
+    if pool is None:
+        pool = rcParams.dicompool
+    paths = list(paths)
     d = dict(errors=[])
-    for p in paths:
-        read_slice(p, d)
+    headers = map_chunks(_read_header, paths, n_jobs=n_jobs, pool=pool)
+    for path, header in zip(paths, headers):
+        add_slice(path, header, d)
+    if 'slices' not in d:
+        raise ValueError('No DICOM images found')
     positions = sorted(d['positions'])
     bvalues = sorted(d['bvalues'])
     echotimes = sorted(d['echotimes'])
-    image = construct_image(d['slices'], positions, bvalues, echotimes)
+    image = construct_image(d['slices'], positions, bvalues, echotimes,
+                            d['shape'], n_jobs=n_jobs, pool=pool)
     if len(bvalues) == image.shape[-1]:
         parameters = bvalues
     elif len(echotimes) == image.shape[-1]:
@@ -74,64 +228,156 @@ def read_files(paths):
                 dicom_dtype=str(d['dtype']), errors=d['errors'])
 
 
-def read_slice(path, d):
-    """Read a single slice."""
+def read_header(path):
+    """Read the header of a single slice, without pixel data. Return
+    a dictionary of slice information, or None if there is no image.
+    """
+    df, has_pixel_data = dcmread_header(path)
+    if not has_pixel_data:
+        return None
+    return dict(
+        orientation=tuple(float(x) for x in df.ImageOrientationPatient),
+        shape=get_pixel_shape(df),
+        dtype=get_pixel_dtype(df),
+        voxel_spacing=get_voxel_spacing(df),
+        position=tuple(float(x) for x in df.ImagePositionPatient),
+        bvalue=get_bvalue(df),
+        echotime=get_echotime(df),
+        )
+
+
+def map_chunks(func, items, n_jobs=1, pool='threads'):
+    """Call `func(item)` for each item like job.map_jobs(), but give each
+    worker task a chunk of items, for which ZIP archives are kept open (see
+    open_archives()).
+    """
+    items = list(items)
+    n = util.job_count(n_jobs)
+    size = max(1, -(-len(items) // (4 * n)))  # About four chunks per worker.
+    chunks = [items[i:i+size] for i in range(0, len(items), size)]
+    results = job.map_jobs(partial(_map_chunk, func), chunks, n_jobs=n_jobs,
+                           prefer=pool)
+    return [y for x in results for y in x]
+
+
+def _map_chunk(func, items):
+    """Worker for map_chunks()."""
+    with open_archives():
+        return [func(x) for x in items]
+
+
+def _read_header(path):
+    """Worker for read_files(), returning the error of an invalid file."""
     try:
-        df = pydicom.read_file(str(path))
-    except pydicom.filereader.InvalidDicomError as e:
-        log.error('Error reading %s: %s', path, e)
-        return
-    if 'PixelData' not in df:
+        return read_header(path)
+    except pydicom.errors.InvalidDicomError as e:
+        return e
+
+
+def add_slice(path, header, d):
+    """Validate a slice header (see read_header()) against the previous ones
+    and add it. The slice file path is stored in `d['slices']` by position,
+    b-value, and echo time.
+    """
+    if isinstance(header, pydicom.errors.InvalidDicomError):
+        log.error('Error reading %s: %s', path, header)
         return
-    d.setdefault('orientation', df.ImageOrientationPatient)
-    if d['orientation'] != df.ImageOrientationPatient:
+    if header is None:
+        return  # No image.
+    d.setdefault('orientation', header['orientation'])
+    if d['orientation'] != header['orientation']:
         raise Exception('Orientation mismatch.')
-    d.setdefault('shape', df.pixel_array.shape)
-    if d['shape'] != df.pixel_array.shape:
+    d.setdefault('shape', header['shape'])
+    if d['shape'] != header['shape']:
         raise Exception('Shape mismatch: {}'.format(path))
-    d.setdefault('dtype', df.pixel_array.dtype)
-    if d['dtype'] != df.pixel_array.dtype:
+    d.setdefault('dtype', header['dtype'])
+    if d['dtype'] != header['dtype']:
         raise Exception('Type mismatch.')
-    d.setdefault('voxel_spacing', get_voxel_spacing(df))
-    position = tuple(float(x) for x in df.ImagePositionPatient)
-    bvalue = get_bvalue(df)
-    echotime = get_echotime(df)
-    pixels = get_pixels(df)
-    d.setdefault('positions', set()).add(position)
-    d.setdefault('bvalues', set()).add(bvalue)
-    d.setdefault('echotimes', set()).add(echotime)
-    key = (position, bvalue, echotime)
+    d.setdefault('voxel_spacing', header['voxel_spacing'])
+    d.setdefault('positions', set()).add(header['position'])
+    d.setdefault('bvalues', set()).add(header['bvalue'])
+    d.setdefault('echotimes', set()).add(header['echotime'])
+    key = (header['position'], header['bvalue'], header['echotime'])
     slices = d.setdefault('slices', {})
     if key in slices:
-        log.error('Overlapping slices (%s), discarding %s', key, path)
-        s = 'Overlapping slices, discarding {}'.format(path)
+        log.error('Overlapping slices (%s), discarding %s', key,
+                  slices[key])
+        s = 'Overlapping slices, discarding {}'.format(slices[key])
         d['errors'].append(s)
-    slices[key] = pixels
+    slices[key] = path
 
 
-def construct_image(slices, positions, bvalues, echotimes):
-    """Construct uniform image array from slice dictionary."""
-    slc = list(slices.values())[0]
-    w, h = slc.shape
-    dtype = slc.dtype
-    shape = (len(positions), w, h, len(bvalues), len(echotimes))
+def construct_image(slices, positions, bvalues, echotimes, shape,
+                    dtype=np.float32, n_jobs=1, pool='threads'):
+    """Construct uniform image array by decoding slice files (by position,
+    b-value, and echo time) directly into it, see read_pixels(). See
+    read_files() for parameters n_jobs and pool.
+    """
+    shape = (len(positions),) + shape + (len(bvalues), len(echotimes))
+    if len(slices) != shape[0] * shape[3] * shape[4]:
+        raise Exception('Slices missing from shape {}.'.format(shape))
+    positions = {x: i for i, x in enumerate(positions)}
+    bvalues = {x: i for i, x in enumerate(bvalues)}
+    echotimes = {x: i for i, x in enumerate(echotimes)}
     image = np.empty(shape, dtype=dtype)
-    image.fill(np.nan)
-    for key, value in slices.items():
-        pos = positions.index(key[0])
-        bv = bvalues.index(key[1])
-        et = echotimes.index(key[2])
-        image[pos, :, :, bv, et] = value
+    outs = [image[positions[pos], :, :, bvalues[bv], echotimes[et]] for
+            pos, bv, et in slices.keys()]
+    if pool == 'processes':
+        # Workers cannot write into the image, their results are copied.
+        args = [(x, None, dtype) for x in slices.values()]
+    else:
+        args = [(x, y, dtype) for x, y in zip(slices.values(), outs)]
+    pixels = map_chunks(_read_pixels, args, n_jobs=n_jobs, pool=pool)
+    for out, a in zip(outs, pixels):
+        if a is not out:
+            out[...] = a
     if image.shape[3] == 1:
         image = image.squeeze(axis=3)
     elif image.shape[4] == 1:
         image = image.squeeze(axis=4)
     assert image.ndim == 4, image.shape
-    if np.isnan(np.min(image)):
-        raise Exception('Slices missing from shape {:s}.'.format(shape))
     return image
 
 
+def read_pixels(path, out=None, dtype=np.float32):
+    """Decode the pixel data of a slice file into an output array (by default
+    a new one), rescaled in place. Return the output array.
+    """
+    df = dcmread(path)
+    pixels = df.pixel_array
+    if out is None:
+        out = np.empty(pixels.shape, dtype=dtype)
+    if pixels.shape != out.shape:
+        raise Exception('Shape mismatch: {}'.format(path))
+    np.copyto(out, pixels, casting='unsafe')
+    out *= df.get('RescaleSlope', 1)
+    out += df.get('RescaleIntercept', 0)
+    return out
+
+
+def _read_pixels(args):
+    """Worker for construct_image()."""
+    return read_pixels(*args)
+
+
+def get_pixel_shape(df):
+    """Return pixel array shape from DICOM header."""
+    shape = (df.Rows, df.Columns)
+    if df.get('NumberOfFrames', 1) > 1:
+        shape = (int(df.NumberOfFrames),) + shape
+    if df.get('SamplesPerPixel', 1) > 1:
+        shape += (df.SamplesPerPixel,)
+    return shape
+
+
+def get_pixel_dtype(df):
+    """Return pixel array data type from DICOM header."""
+    if df.BitsAllocated == 1:
+        return np.dtype(np.uint8)  # Bit-packed, unpacked to bytes.
+    kind = 'i' if df.get('PixelRepresentation', 0) else 'u'
+    return np.dtype('{}{}'.format(kind, df.BitsAllocated // 8))
+
+
 def get_bvalue(df):
     """Return image b-value. Default to 0 if not found.
 
@@ -171,18 +417,6 @@ def get_echotime(df):
     return r
 
 
-def get_pixels(df, dtype=np.float32):
-    """Return rescaled pixel array from DICOM object."""
-    pixels = df.pixel_array
-    pixels = pixels.astype(dtype)
-    pixels = pixels * df.get('RescaleSlope', 1) + df.get('RescaleIntercept', 0)
-    # # Clipping should not be done.
-    # lowest = df.WindowCenter - df.WindowWidth/2
-    # highest = df.WindowCenter + df.WindowWidth/2
-    # pixels = pixels.clip(lowest, highest, out=pixels)
-    return pixels
-
-
 def get_voxel_spacing(df):
     """Return voxel spacing in millimeters as (z, y, x)."""
     # Note: Some manufacturers misinterpret SpacingBetweenSlices, it would be
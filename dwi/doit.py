@@ -31,20 +31,11 @@ def get_config():
 
 def get_num_process(factor=0.9, default=1):
     """Take a pick how many processes we want to run simultaneously."""
-    maxjobs = rcParams.maxjobs
     try:
-        if maxjobs < 0:
-            # Joblib-type negative count: -1 => all, -2 => all but one, etc.
-            n = util.cpu_count() + maxjobs + 1
-        elif maxjobs < 1:
-            # Portion of CPU count.
-            n = util.cpu_count() * maxjobs
-        else:
-            # Absolute number.
-            n = maxjobs
+        n = util.job_count(rcParams.maxjobs)
     except OSError:
         n = default
-    return int(max(1, n))
+    return n
 
 
 def words(string, sep=','):
@@ -117,12 +108,14 @@ def texture_methods_winsizes(mode, masktype):
 
 
 def texture_params(voxels=None):
-    """Iterate texture parameter combinations."""
+    """Iterate texture parameter combinations. Voxel outputs are given
+    together, as they are all produced from the same texture map.
+    """
     masktypes = ['lesion']
     slices = ['maxfirst', 'all']
     portion = [1, 0]
-    voxels = iter(voxels or ['mean', 'median', 'all'])
-    return product(masktypes, slices, portion, voxels)
+    voxels = tuple(voxels or ['mean', 'median', 'all'])
+    return product(masktypes, slices, portion, [voxels])
 
 
 def find_roi_param_combinations(mode, samplelist):
@@ -9,7 +9,7 @@ from contextlib import contextmanager
 
 import numpy as np
 
-from . import asciifile, dicomfile, hdf5, nifti
+from . import asciifile, dicomfile, hdf5, nifti, pmapcache
 from .types import Lesion, Patient
 from .types import Path
 
@@ -187,8 +187,13 @@ def guess_format(path):
 
 
 def write_pmap(filename, pmap, attrs, fmt=None):
-    """Write parametric map file either as HDF5 or ASCII."""
-    pmap = np.asanyarray(pmap)
+    """Write parametric map file either as HDF5 or ASCII.
+
+    The map may also be an HDF5 dataset, it is copied by slices into an HDF5
+    file.
+    """
+    if not isinstance(pmap, hdf5.h5py.Dataset):
+        pmap = np.asanyarray(pmap)
     if pmap.ndim < 2:
         raise Exception(f'Not enough dimensions: {pmap.shape}')
     if 'parameters' not in attrs:
@@ -206,7 +211,7 @@ def write_pmap(filename, pmap, attrs, fmt=None):
     if fmt == 'h5':
         hdf5.write_hdf5(filename, pmap, attrs)
     elif fmt == 'txt':
-        pmap = pmap.reshape((-1, pmap.shape[-1]))  # Can't keep shape.
+        pmap = np.reshape(pmap, (-1, pmap.shape[-1]))  # Can't keep shape.
         asciifile.write_ascii_file(filename, pmap, None, attrs=attrs)
     else:
         raise Exception(f'Cannot write format: {fmt}')
@@ -223,48 +228,100 @@ def asindices(iterable, lst):
             yield int(item)  # Not found, convert to integer.
 
 
+def region_slices(region):
+    """Convert a region, given as slices or (start, stop) pairs like a
+    bounding box, into a tuple of slices.
+    """
+    return tuple(x if isinstance(x, slice) else slice(*x) for x in region)
+
+
+def select_pmap(pmap, attrs, region=None, params=None):
+    """Select a spatial region and a subset of parameters of a map.
+
+    The region is given for leading axes as slices or a bounding box (see
+    region_slices()), and parameters by their indices or names. If the map is
+    an HDF5 dataset, only the selection is read from disk.
+    """
+    region = region_slices(region or ())
+    if len(region) >= pmap.ndim:
+        raise ValueError('Region has too many dimensions: {}'.format(region))
+    indices = None
+    if params is not None:
+        indices = list(asindices(params, attrs['parameters']))
+    if isinstance(pmap, hdf5.h5py.Dataset):
+        pmap = hdf5.read_hyperslab(pmap, region, indices)
+    else:
+        pmap = pmap[region]
+        if indices is not None:
+            pmap = pmap[..., indices]
+    if indices is not None:
+        n = len(attrs['parameters'])
+        for k in ('bset', 'echotimes'):
+            if k in attrs and len(attrs[k]) == n:
+                attrs[k] = [attrs[k][x] for x in indices]
+        attrs['parameters'] = [attrs['parameters'][x] for x in indices]
+    return pmap, attrs
+
+
 def pick_params(pmap, attrs, params):
     """Select a subset of parameters by their indices or names."""
-    params = list(asindices(params, attrs['parameters']))
-    pmap = pmap[..., params]
-    if 'bset' in attrs and len(attrs['bset']) == len(attrs['parameters']):
-        attrs['bset'] = [attrs['bset'][x] for x in params]
-    if 'echotimes' in attrs and (len(attrs['echotimes']) ==
-                                 len(attrs['parameters'])):
-        attrs['echotimes'] = [attrs['echotimes'][x] for x in params]
-    attrs['parameters'] = [attrs['parameters'][x] for x in params]
-    return pmap, attrs
+    return select_pmap(pmap, attrs, params=params)
+
+
+def set_parameters(attrs, n):
+    """Set parameter names as strings, by default their indices."""
+    if 'parameters' not in attrs:
+        attrs['parameters'] = range(n)
+    attrs['parameters'] = [str(x) for x in attrs['parameters']]
+    return attrs
+
 
+def read_dicom(path, read=dicomfile.read):
+    """Read a DICOM image. Return the image and its attributes."""
+    d = read(path)
+    pmap = d.pop('image')
+    return pmap, dict(d)
 
-def read_pmap(path, ondisk=False, fmt=None, params=None, dtype=None):
+
+def read_zip(path):
+    """Read a DICOM image from a ZIP archive. See read_dicom()."""
+    return read_dicom(path, read=dicomfile.read_zip)
+
+
+def read_pmap(path, ondisk=False, fmt=None, params=None, dtype=None,
+              region=None):
     """Read a parametric map.
 
     With parameter ondisk it will not be read into memory. Parameter params
-    tells which parameter indices should be included.
+    tells which parameter indices should be included, and region which part of
+    the image, see select_pmap(). With HDF5 they are read directly from disk,
+    even with ondisk. Images converted from DICOM are cached, see pmapcache.
     """
     if fmt is None:
         fmt = guess_format(path)
     if fmt == 'h5':
-        pmap, attrs = hdf5.read_hdf5(path, ondisk=ondisk)
+        pmap, attrs = hdf5.read_hdf5(path, ondisk=True)
+        set_parameters(attrs, pmap.shape[-1])
+        if not ondisk or params is not None or region is not None:
+            dset = pmap
+            try:
+                pmap, attrs = select_pmap(dset, attrs, region=region,
+                                          params=params)
+            finally:
+                dset.file.close()
+            params = region = None
     elif fmt == 'txt':
         attrs, pmap = asciifile.read_ascii_file(path)
         if 'parameters' in attrs:
             attrs['parameters'] = attrs['parameters'].split()
     elif fmt == 'nifti':
         attrs, pmap = nifti.read(path)
-    elif fmt == 'zip':
-        with read_archive(path) as tempdir:
-            return read_pmap(tempdir, ondisk=ondisk, fmt=None, params=params,
-                             dtype=dtype)
-    elif fmt == 'dicom':
-        d = dicomfile.read(path)
-        pmap = d.pop('image')
-        attrs = dict(d)
-    if 'parameters' not in attrs:
-        attrs['parameters'] = range(pmap.shape[-1])
-    attrs['parameters'] = [str(x) for x in attrs['parameters']]
-    if params is not None:
-        pmap, attrs = pick_params(pmap, attrs, params)
+    elif fmt in ('zip', 'dicom'):
+        read = read_zip if fmt == 'zip' else read_dicom
+        pmap, attrs = pmapcache.cached(read, path)
+    set_parameters(attrs, pmap.shape[-1])
+    if params is not None or region is not None:
+        pmap, attrs = select_pmap(pmap, attrs, region=region, params=params)
     if dtype is not None:
         pmap = pmap.astype(dtype)
     log.debug('Read %s, %s, %s', path, pmap.shape, pmap.dtype)
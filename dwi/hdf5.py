@@ -15,6 +15,14 @@ DEFAULT_DSETPARAMS = dict(
     fletcher32=True,  # Flether32 checksum.
     track_times=False,  # Dataset creation timestamps.
 )
+# Parameters for datasets that are written piece by piece, like temporary
+# on-disk arrays. They are recompressed when written out by write_hdf5().
+FAST_DSETPARAMS = dict(
+    compression='lzf',  # Faster.
+    shuffle=True,
+    track_times=False,
+)
+CHUNK_NBYTES = 2**20  # Approximate maximum chunk size.
 
 
 def iterable(x):
@@ -31,10 +39,21 @@ def write_hdf5(filename, array, attrs, fillvalue=None,
                dsetname=DEFAULT_DSETNAME):
     """Write an array with attributes into a newly created, compressed HDF5
     file.
+
+    If the array is an HDF5 dataset, it is copied by slices of the first axis
+    without reading it all into memory.
     """
     f = h5py.File(filename, 'w')
-    dset = f.create_dataset(dsetname, data=array, fillvalue=fillvalue,
-                            **DEFAULT_DSETPARAMS)
+    if isinstance(array, h5py.Dataset):
+        dset = f.create_dataset(dsetname, array.shape, dtype=array.dtype,
+                                fillvalue=fillvalue,
+                                chunks=chunk_shape(array.shape, array.dtype),
+                                **DEFAULT_DSETPARAMS)
+        for i in range(len(array)):
+            dset[i] = array[i]
+    else:
+        dset = f.create_dataset(dsetname, data=array, fillvalue=fillvalue,
+                                **DEFAULT_DSETPARAMS)
     write_attrs(dset, attrs)
     f.close()
 
@@ -71,18 +90,74 @@ def read_hdf5(filename, ondisk=False, dsetname=DEFAULT_DSETNAME):
     return array, attrs
 
 
+def read_hyperslab(dset, region=(), indices=None):
+    """Read a part of a dataset into memory. Only the chunks that intersect
+    with it are read and decompressed.
+
+    Parameter region is a tuple of slices for leading axes, and indices is an
+    optional sequence of indices on the last axis. Indices may be in any order
+    and repeat: they are read in ascending order, as HDF5 requires, and
+    rearranged in memory.
+    """
+    region = tuple(region)
+    if indices is None:
+        return dset[region]
+    n = dset.shape[-1]
+    indices = list(indices)
+    for i in indices:
+        if not -n <= i < n:
+            raise IndexError('Index {} out of range: {}'.format(i, n))
+    unique, inverse = np.unique([i % n for i in indices], return_inverse=True)
+    region += (slice(None),) * (dset.ndim - 1 - len(region))
+    if not len(unique):
+        return dset[region + (slice(0, 0),)]
+    if unique[-1] - unique[0] + 1 == len(unique):
+        selection = slice(unique[0], unique[-1] + 1)  # Contiguous, faster.
+    else:
+        selection = list(unique)
+    array = dset[region + (selection,)]
+    if len(unique) != len(indices) or np.any(np.diff(inverse) != 1):
+        array = array[..., inverse]
+    return array
+
+
 def create_hdf5(filename, shape, dtype, fillvalue=None,
-                dsetname=DEFAULT_DSETNAME):
+                dsetname=DEFAULT_DSETNAME, fast=False):
     """Create a HDF5 file and return the dataset for manipulation.
 
     Attributes and the file object can be accessed by dset.attrs and dset.file.
+
+    With parameter "fast" True the dataset is meant for writing by slices of
+    the first axis: it is chunked accordingly (see chunk_shape()), and uses
+    a faster compression.
     """
     f = h5py.File(filename, 'w')
+    if fast:
+        params = dict(FAST_DSETPARAMS, chunks=chunk_shape(shape, dtype))
+    else:
+        params = DEFAULT_DSETPARAMS
     dset = f.create_dataset(dsetname, shape, dtype=dtype, fillvalue=fillvalue,
-                            **DEFAULT_DSETPARAMS)
+                            **params)
     return dset
 
 
+def chunk_shape(shape, dtype, nbytes=CHUNK_NBYTES):
+    """Return a chunk shape aligned with slices of the first axis.
+
+    A chunk is one slice of the first axis, and covers the following axes
+    wholly, except for those it must be split along to keep it within about
+    `nbytes`. So writing whole slices never touches a chunk partially.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    chunks = [1] + [max(1, x) for x in shape[1:]]
+    for i in range(1, len(chunks)):
+        rest = itemsize * int(np.prod(chunks[i+1:]))
+        chunks[i] = max(1, min(chunks[i], nbytes // rest))
+        if chunks[i] > 1 or rest <= nbytes:
+            break
+    return tuple(chunks)
+
+
 def write_attrs(dset, attrs):
     """Update dataset attributes from dictionary. This is a wrapper for
     conversion needs, like string encoding and None to nan.
@@ -6,10 +6,13 @@
 # TODO: Configuration.
 
 from functools import partial
+from itertools import product
 
 import joblib
+import numpy as np
 
 import dwi
+import dwi.util
 
 _memory_defaults = dict(
     # cachedir='cache',
@@ -38,3 +41,75 @@ delayed = partial(joblib.delayed)
 
 dump = partial(joblib.dump)
 load = partial(joblib.load)
+
+
+def tile_boxes(shape, tileshape, halo=0, mask=None):
+    """Split an array into tiles with a halo around each.
+
+    Yield pairs of boxes (tuples of slices): the tile, and the tile extended by
+    halo, clipped to array. Parameter tileshape may have None for whole axis.
+    Parameter halo is a number or sequence of them, or (before, after) pairs
+    for each axis. If a mask is given, tiles are shrunk to the bounding box of
+    their selected voxels, and tiles without any are skipped.
+    """
+    tileshape = [t or n for t, n in zip(tileshape, shape)]
+    halo = [x if isinstance(x, (tuple, list)) else (x, x) for x in
+            dwi.util.normalize_sequence(halo, len(shape))]
+    starts = product(*(range(0, n, t) for n, t in zip(shape, tileshape)))
+    for start in starts:
+        box = tuple(slice(a, min(a + t, n)) for a, t, n in
+                    zip(start, tileshape, shape))
+        if mask is not None:
+            if not np.any(mask[box]):
+                continue
+            box = tuple(slice(x.start + a, x.start + b) for x, (a, b) in
+                        zip(box, dwi.util.bounding_box(mask[box])))
+        padded = tuple(slice(max(x.start - b, 0), min(x.stop + a, n)) for
+                       x, (b, a), n in zip(box, halo, shape))
+        yield box, padded
+
+
+def _call_tile(func, arrays, box, args, params):
+    """Worker for map_tiles()."""
+    vars(dwi.rcParams).update(params)
+    return func(*tuple(a[box] for a in arrays) + tuple(args))
+
+
+def map_tiles(func, arrays, boxes, args=None, n_jobs=None):
+    """Call `func(*[a[box] for a in arrays] + args)` for each box (and its
+    arguments, if given) in parallel, and return the results in order.
+
+    Number of processes is by default from rcParams.tilejobs. The workers get
+    the input arrays by memory mapping, so they are not copied for each tile.
+    Large ones are mapped read-only, so func must not write to its inputs.
+    """
+    boxes = list(boxes)
+    if args is None:
+        args = [()] * len(boxes)
+    if n_jobs is None:
+        n_jobs = dwi.util.job_count(dwi.rcParams.tilejobs)
+    if n_jobs == 1 or len(boxes) < 2:
+        return [func(*tuple(a[box] for a in arrays) + tuple(x)) for box, x in
+                zip(boxes, args)]
+    # Configuration may have been modified after workers imported it.
+    params = vars(dwi.rcParams)
+    parallel = Parallel(n_jobs=min(n_jobs, len(boxes)), verbose=0,
+                        max_nbytes='1M', mmap_mode='r')
+    return parallel(delayed(_call_tile)(func, arrays, box, x, params) for
+                    box, x in zip(boxes, args))
+
+
+def map_jobs(func, items, n_jobs=1, prefer='threads'):
+    """Call `func(item)` for each item in parallel, and return the results in
+    order, regardless of completion order.
+
+    Parameter n_jobs is the number of workers, see dwi.util.job_count().
+    Parameter prefer is 'threads' or 'processes'.
+    """
+    items = list(items)
+    n_jobs = dwi.util.job_count(n_jobs)
+    if n_jobs == 1 or len(items) < 2:
+        return [func(x) for x in items]
+    parallel = Parallel(n_jobs=min(n_jobs, len(items)), verbose=0,
+                        prefer=prefer)
+    return parallel(delayed(func)(x) for x in items)
@@ -223,10 +223,11 @@ def border(mask, out=None):
         out = np.zeros_like(mask, dtype=np.bool)
     # Try to guess a good window shape; thicker border for bigger resolution.
     winshape = [max(x // 70, 3) for x in mask.shape]
-    for i, win in dwi.util.sliding_window(mask, winshape):
-        selected = np.count_nonzero(win) / win.size
-        if 0.3 < selected < 0.6:
-            out[i] = True
+    for origins, windows in dwi.util.window_batches(mask, winshape):
+        windows = windows.reshape(len(windows), -1)
+        selected = np.count_nonzero(windows, axis=1) / windows.shape[1]
+        edge = (0.3 < selected) & (selected < 0.6)
+        out[tuple(x[edge] for x in origins)] = True
     return out
 
 
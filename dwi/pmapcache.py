@@ -0,0 +1,143 @@
+"""Cache of images converted from slow-to-read formats like DICOM.
+
+A converted image is stored as an uncompressed joblib dump of the image array
+and its attributes in the 'pmaps' subdirectory of rcParams.cachedir. The entry
+name is a hash of the source path, its size and modification time (summed and
+maximized over files for a directory), and dicomfile.READER_VERSION, so it is
+not used after the source or the reader changes. The cache is limited to
+rcParams.pmapcache_size megabytes by evicting least recently used entries,
+which are tracked by modification time. A size of zero disables the cache.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+
+from .conf import rcParams
+from .types import Path
+from . import dicomfile, job
+
+log = logging.getLogger(__name__)
+SUFFIX = '.pkl'
+
+
+def cache_dir():
+    """Return the cache directory."""
+    return Path(rcParams.cachedir) / 'pmaps'
+
+
+def size_limit():
+    """Return the cache size limit in bytes."""
+    return int(rcParams.pmapcache_size * 2**20)
+
+
+def source_stat(path):
+    """Return total size, latest modification time, and file count of a file
+    or a directory tree.
+    """
+    path = Path(path)
+    if not path.is_dir():
+        st = path.stat()
+        return st.st_size, st.st_mtime_ns, 1
+    size, mtime, count = 0, path.stat().st_mtime_ns, 0
+    for dirpath, _, filenames in os.walk(str(path)):
+        for filename in filenames:
+            st = os.stat(os.path.join(dirpath, filename))
+            size += st.st_size
+            mtime = max(mtime, st.st_mtime_ns)
+            count += 1
+    return size, mtime, count
+
+
+def key(path):
+    """Return cache key of a source path."""
+    path = Path(path).resolve()
+    s = repr((str(path), source_stat(path), dicomfile.READER_VERSION))
+    return hashlib.sha1(s.encode()).hexdigest()
+
+
+def entries():
+    """Return cache entry paths, least recently used first."""
+    d = cache_dir()
+    if not d.is_dir():
+        return []
+    paths = d.glob('*' + SUFFIX)
+    return sorted(paths, key=lambda x: x.stat().st_mtime_ns)
+
+
+def load(path):
+    """Load a cached image and its attributes, or return None if missing."""
+    entry = cache_dir() / (key(path) + SUFFIX)
+    try:
+        pmap, attrs = job.load(str(entry))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning('Removing unreadable cache entry %s: %s', entry, e)
+        remove(entry)
+        return None
+    try:
+        os.utime(str(entry))  # Mark as recently used.
+    except FileNotFoundError:
+        pass  # Evicted by another process meanwhile.
+    log.debug('Loaded %s from cache %s', path, entry)
+    return pmap, attrs
+
+
+def save(path, pmap, attrs):
+    """Save an image and its attributes to cache, then evict old entries."""
+    d = cache_dir()
+    d.mkdir(parents=True, exist_ok=True)
+    entry = d / (key(path) + SUFFIX)
+    # Write to a temporary file first, so that others never see a partial one.
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=str(d))
+    os.close(fd)
+    try:
+        job.dump((pmap, attrs), tmp)
+        os.replace(tmp, str(entry))
+    except BaseException:
+        remove(tmp)
+        raise
+    log.debug('Saved %s to cache %s', path, entry)
+    evict(size_limit())
+
+
+def evict(limit):
+    """Remove least recently used entries until cache size is within limit."""
+    paths = entries()
+    sizes = [x.stat().st_size for x in paths]
+    total = sum(sizes)
+    for path, size in zip(paths, sizes):
+        if total <= limit:
+            break
+        log.debug('Evicting cache entry %s', path)
+        remove(path)
+        total -= size
+
+
+def remove(path):
+    """Remove a file if it exists."""
+    try:
+        os.remove(str(path))
+    except FileNotFoundError:
+        pass
+
+
+def cached(read, path):
+    """Read an image using cache, if enabled.
+
+    Parameter read is a function that takes the path and returns the image and
+    its attribute dictionary, which should be picklable.
+    """
+    if size_limit() <= 0:
+        return read(path)
+    loaded = load(path)
+    if loaded is not None:
+        return loaded
+    pmap, attrs = read(path)
+    try:
+        save(path, pmap, attrs)
+    except OSError as e:
+        log.warning('Cannot cache %s: %s', path, e)
+    return pmap, attrs
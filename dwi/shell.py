@@ -53,6 +53,23 @@ def get_texture(mode, inpath, tspec, slices, portion, outpath, voxel,
     return cmd.format(**d)
 
 
+def get_textures(mode, inpath, tspecs, slices, portion, outpaths, voxels,
+                 mask=None):
+    """Calculate several texture methods into one file per voxel output."""
+    d = dict(prg=DWILIB/'get_texture.py', m=mode, i=inpath, mask=mask,
+             slices=slices, portion=portion, t=' '.join(map(str, tspecs)),
+             o=' '.join(map(str, outpaths)), vx=' '.join(voxels))
+    cmd = ('{prg} -v'
+           ' --mode {m}'
+           ' --input {i}'
+           ' --slices {slices} --portion {portion}'
+           ' --tspec {t} --voxel {vx}'
+           ' --output {o}')
+    if mask is not None:
+        cmd += ' --mask {mask}'
+    return cmd.format(**d)
+
+
 def make_subregion(mask, subregion):
     d = dict(prg=DWILIB/'masktool.py', mask=mask, sr=subregion)
     cmd = '{prg} -i {mask} --pad 10 -s {sr}'
@@ -13,12 +13,15 @@ Scikit-image and Mahotas libraries are used for the calculations.
 """
 
 from collections import OrderedDict
+from functools import partial
 import logging
 
 import numpy as np
 import scipy as sp
+from scipy import ndimage
 
 import dwi.hdf5
+import dwi.job
 import dwi.util
 import dwi.texture_mahotas
 import dwi.texture_skimage
@@ -26,49 +29,78 @@ import dwi.texture_skimage
 
 def raw_map(img, winsize, mask=None, output=None):
     assert winsize == 1, winsize
-    return img, ['raw']
+    return img[np.newaxis], ['raw']
 
 
 # Basic statistical features
 
 
-def stats(img):
-    """Statistical texture features that don't consider spatial relations."""
+STATS_P_RANKS = sorted(list(range(0, 101, 10)) + [25, 75])
+STATS_NAMES = (['p{:03d}'.format(x) for x in STATS_P_RANKS] +
+               ['range', 'mean', 'stddev', 'kurtosis', 'skewness'])
+
+
+def stats(img, axis=None, names=None):
+    """Statistical texture features that don't consider spatial relations.
+
+    If axis is given, features are calculated along it, for a stack of
+    samples. Parameter names may list the features to calculate, out of
+    STATS_NAMES.
+    """
     # TODO: Consider IQR, MAD, interdecile range, midhinge, trimean, trimmed
     # mean, winsorized mean.
     img = np.asanyarray(img)
+    if axis is None:
+        img = img.ravel()
+        axis = 0
+    if names is None:
+        names = STATS_NAMES
     d = OrderedDict()
     # Add percentiles.
-    p_ranks = sorted(list(range(0, 101, 10)) + [25, 75])
-    for p_rank, p in zip(p_ranks, np.percentile(img, p_ranks)):
-        d['p{:03d}'.format(p_rank)] = p
-    d['range'] = d['p100'] - d['p000']
-    d['mean'] = np.mean(img)
-    d['stddev'] = np.std(img)
-    d['kurtosis'] = sp.stats.kurtosis(img.ravel())
-    d['skewness'] = sp.stats.skew(img.ravel())
-    return d
-
-
-def stats_map(img, winsize, mask=None, output=None):
-    """Statistical texture feature map."""
-    for pos, win in dwi.util.sliding_window(img, winsize, mask=mask):
-        d = stats(win)
-        names = list(d.keys())
-        if output is None:
-            dtype = dwi.rcParams.texture_dtype
-            output = np.zeros((len(names),) + img.shape, dtype=dtype)
-        for i, value in enumerate(d.values()):
-            output[(i,) + pos] = value
+    p_ranks = [x for x in STATS_P_RANKS if 'p{:03d}'.format(x) in names or
+               ('range' in names and x in (0, 100))]
+    if p_ranks:
+        for p_rank, p in zip(p_ranks, np.percentile(img, p_ranks,
+                                                    axis=axis)):
+            d['p{:03d}'.format(p_rank)] = p
+    if 'range' in names:
+        d['range'] = d['p100'] - d['p000']
+    if 'mean' in names:
+        d['mean'] = np.mean(img, axis=axis)
+    if 'stddev' in names:
+        d['stddev'] = np.std(img, axis=axis)
+    if 'kurtosis' in names:
+        d['kurtosis'] = sp.stats.kurtosis(img, axis=axis)
+    if 'skewness' in names:
+        d['skewness'] = sp.stats.skew(img, axis=axis)
+    return OrderedDict((x, d[x]) for x in STATS_NAMES if x in names)
+
+
+def stats_map(img, winsize, mask=None, output=None, chunksize=4096,
+              features=None):
+    """Statistical texture feature map.
+
+    Features of the windows are calculated together in chunks of `chunksize`,
+    see dwi.util.window_batches(). Parameter features may list the features
+    to calculate.
+    """
+    names = [x for x in STATS_NAMES if features is None or x in features]
+    if output is None:
+        dtype = dwi.rcParams.texture_dtype
+        output = np.zeros((len(names),) + np.shape(img), dtype=dtype)
+    for origins, windows in dwi.util.window_batches(img, winsize, mask=mask,
+                                                    batchsize=chunksize):
+        d = stats(windows.reshape(len(windows), -1), axis=1, names=names)
+        output[(slice(None),) + origins] = list(d.values())
     names = ['stats({})'.format(x) for x in names]
     return output, names
 
 
-def stats_mbb(img, mask):
+def stats_mbb(img, mask, features=None):
     """Statistical texture features unified over a masked area."""
     # TODO: Add area size?
     voxels = img[mask]
-    feats = stats(voxels)
+    feats = stats(voxels, names=features)
     output = list(feats.values())
     names = ['stats({})'.format(x) for x in feats.keys()]
     return output, names
@@ -99,100 +131,754 @@ METHODS = OrderedDict([
     # Methods that consider all selected voxels.
     ('stats_all', stats_mbb),  # Use the same mbb function.
 ])
+# Methods that take a `features` argument for calculating only the requested
+# features, see feature_key(). Others calculate all and they are selected.
+SELECTIVE_METHODS = ('stats', 'glcm', 'gabor', 'haar', 'stats_mbb', 'glcm_mbb',
+                     'stats_all')
+# Window methods that calculate maps for several window sizes at once, sharing
+# the work that does not depend on window size.
+MULTI_METHODS = OrderedDict([
+    ('lbp', dwi.texture_skimage.lbp_freq_maps),
+    ('gabor', dwi.texture_skimage.gabor_maps),
+    ('haar', dwi.texture_mahotas.haar_maps),
+])
+# Window methods that may be approximated at reduced resolution for large
+# windows, see get_texture_approx().
+APPROX_METHODS = ('stats', 'glcm', 'lbp', 'hog', 'gabor', 'hu', 'zernike')
+
+
+def feature_key(name):
+    """Return the feature part of a texture feature name, as in
+    TextureSpec.feature. For example, '5-glcm(contrast,2,mean)',
+    'ADCk-5-glcm(contrast,2,mean)' and 'glcm(contrast,2,mean)' give
+    'contrast,2,mean', and '3-sobel' gives 'sobel'.
+    """
+    if '(' in name:
+        return name[name.index('(')+1:name.rindex(')')]
+    return name.rsplit('-', 1)[-1]
+
+
+def select_features(tmap, names, features):
+    """Select requested features (see feature_key()) from a voxel texture
+    map, keeping their order.
+    """
+    keys = [feature_key(x) for x in names]
+    missing = [x for x in features if x not in keys]
+    if missing:
+        raise ValueError('Features not available: {}'.format(missing))
+    indices = [i for i, x in enumerate(keys) if x in features]
+    return tmap[:, indices], [names[i] for i in indices]
+
+
+def _call_params(call, img, *args, **kwargs):
+    """Call a texture method for each parameter on the last axis of the
+    image, concatenating the features in parameter order.
+    """
+    results = [call(np.ascontiguousarray(img[..., i]), *args, **kwargs)
+               for i in range(img.shape[-1])]
+    if isinstance(results[0], list):
+        # Method in MULTI_METHODS, with a result for each window size.
+        return [_concat_results(x) for x in zip(*results)]
+    return _concat_results(results)
+
+
+def _concat_results(results):
+    """Concatenate texture method results of parameters."""
+    feats = np.concatenate([x for x, _ in results], axis=0)
+    names = sum((x for _, x in results), [])
+    return feats, names
+
+
+def prefix_params(names, params):
+    """Prefix feature names with parameter names. The features are in
+    a block for each parameter, like from a 4D image.
+    """
+    n = len(names) // len(params)
+    assert n * len(params) == len(names), (len(names), len(params))
+    return ['{p}-{n}'.format(p=p, n=x) for i, p in enumerate(params) for x in
+            names[i*n:(i+1)*n]]
 
 
 def get_texture_all(img, call, mask):
     feats, names = call(img, mask=mask)
     dtype = dwi.rcParams.texture_dtype
-    tmap = np.full(img.shape + (len(names),), np.nan, dtype=dtype)
-    tmap[mask, :] = feats
+    tmap = np.empty((np.count_nonzero(mask), len(names)), dtype=dtype)
+    tmap[...] = feats
     return tmap, names
 
 
 def get_texture_mbb(img, call, mask):
-    tmap = None
-    for i, (img_slice, mask_slice) in enumerate(zip(img, mask)):
-        if np.count_nonzero(mask_slice):
-            feats, names = call(img_slice, mask=mask_slice)
-            if tmap is None:
-                dtype = dwi.rcParams.texture_dtype
-                tmap = np.full(img.shape + (len(names),), np.nan, dtype=dtype)
-            tmap[i, mask_slice, :] = feats
+    """Calculate texture features slice by slice, over the selected voxels."""
+    boxes = [box for box, _ in dwi.job.tile_boxes(mask.shape, (1, None, None))
+             if np.any(mask[box])]
+    results = dwi.job.map_tiles(_mbb_tile, [img, mask], boxes, args=[(call,)] *
+                                len(boxes))
+    dtype = dwi.rcParams.texture_dtype
+    tmap = np.empty((np.count_nonzero(mask), len(results[0][1])),
+                    dtype=dtype)
+    start = 0
+    for box, (feats, names) in zip(boxes, results):
+        n = np.count_nonzero(mask[box])
+        tmap[start:start+n, :] = feats
+        start += n
     return tmap, names
 
 
-def get_texture_map(img, call, winsize, mask):
+def _mbb_tile(img, mask, call):
+    """Calculate texture features of a slice, see get_texture_mbb()."""
+    return call(img[0], mask=mask[0])
+
+
+def filter_support(method, winsize):
+    """Return how far beyond the window a texture map method looks at the
+    image, or None if it needs the whole slice.
+    """
+    if method == 'lbp':
+        return winsize // 2  # LBP radius.
+    elif method == 'gabor':
+        return dwi.texture_skimage.gabor_support()
+    elif method == 'sobel':
+        return None  # Masked filter depends on mask around the voxels.
+    elif method == 'haar':
+        return None  # Spline upsampling of bands has global support.
+    return 0
+
+
+def get_texture_map(img, call, winsize, mask, support=0):
+    """Calculate texture map in tiles of each slice, see get_texture_maps()."""
+    tmaps, names = get_texture_maps(img, partial(_call_each, call), [winsize],
+                                    [mask], [support])
+    return tmaps[0], names[0]
+
+
+def _call_each(call, img, winsizes, masks=None):
+    """Call a single window size method for each window size."""
+    return [call(img, w, mask=m) for w, m in zip(winsizes, masks)]
+
+
+def get_texture_maps(img, call, winsizes, masks, supports):
+    """Calculate texture maps for several window sizes (each with own mask and
+    filter support) in tiles of each slice. The method is called like those
+    in MULTI_METHODS. Return lists of texture maps and feature names.
+
+    If no support is None, the slices are split into tiles of at most
+    rcParams.tilesize, each shrunk to the bounding box of its selected voxels,
+    and processed with a halo that covers the windows and the filter support,
+    see filter_support(). Otherwise the slices are processed whole. Tiles are
+    processed in parallel, see dwi.job.map_tiles().
+    """
+    masks = np.stack(masks, axis=-1)
+    union = np.any(masks, axis=-1)
+    if any(x is None for x in supports):
+        boxes = [(box, box) for box, _ in
+                 dwi.job.tile_boxes(union.shape, (1, None, None))
+                 if np.any(union[box])]
+    else:
+        tilesize = dwi.rcParams.tilesize
+        halo = (max(w // 2 + s for w, s in zip(winsizes, supports)),
+                max(w - w // 2 - 1 + s for w, s in zip(winsizes, supports)))
+        boxes = [(box, _fit_window(padded, max(winsizes), union.shape)) for
+                 box, padded in dwi.job.tile_boxes(
+                     union.shape, (1, tilesize, tilesize),
+                     halo=(0, halo, halo), mask=union)]
+    # Tile positions within the padded tiles.
+    args = [(call, winsizes, tuple(slice(x.start - y.start, x.stop - y.start)
+                                   for x, y in zip(box, padded)))
+            for box, padded in boxes]
+    results = dwi.job.map_tiles(_map_tile, [img, masks],
+                                [padded for _, padded in boxes], args=args)
+    dtype = dwi.rcParams.texture_dtype
+    tmaps = []
+    names = []
+    for i in range(len(winsizes)):
+        mask = masks[..., i]
+        # Voxel indices of selected voxels in the order of `mask.nonzero()`.
+        index = np.zeros(mask.shape, dtype=np.intp)
+        index[mask] = np.arange(np.count_nonzero(mask))
+        tmap = np.empty((np.count_nonzero(mask), len(results[0][i][1])),
+                        dtype=dtype)
+        for (box, _), result in zip(boxes, results):
+            tmap[index[box][mask[box]], :] = result[i][0]
+        tmaps.append(tmap)
+        names.append(results[0][i][1])
+    return tmaps, names
+
+
+def _fit_window(box, winsize, shape):
+    """Grow a slice box within shape to fit at least one window."""
+    def fit(x, n):
+        start = min(x.start, max(n - winsize, 0))
+        return slice(start, min(max(x.stop, start + winsize), n))
+    return box[:1] + tuple(fit(x, n) for x, n in zip(box[1:], shape[1:]))
+
+
+def _map_tile(img, masks, call, winsizes, box):
+    """Calculate texture maps of the selected voxels within a tile box of a
+    padded tile, see get_texture_maps().
+    """
+    tilemasks = []
+    selected = []
+    for i, winsize in enumerate(winsizes):
+        tilemask = np.zeros(masks.shape[1:3], dtype=bool)
+        tilemask[box[1:]] = masks[box][0, ..., i]
+        selected.append(tilemask.copy())
+        # The methods need at least one full window, so add one if there are
+        # only selected voxels close to image border.
+        origins = tuple(slice(winsize // 2, n - winsize + winsize // 2 + 1)
+                        for n in tilemask.shape)
+        if not np.any(tilemask[origins]):
+            tilemask[winsize // 2, winsize // 2] = True
+        tilemasks.append(tilemask)
+    results = call(img[0], winsizes, masks=tilemasks)
+    return [(feats[:, x].T, names) for (feats, names), x in
+            zip(results, selected)]
+
+
+def densify_tmap(tmap, mask, bufsize=2**26):
+    """Return a dense texture map of shape `mask.shape + (features,)` from
+    a voxel texture map, with background filled with NaN. See
+    densify_tmaps().
+    """
+    return densify_tmaps([tmap], [mask], bufsize=bufsize)
+
+
+def densify_tmaps(tmaps, masks, bufsize=2**26):
+    """Return a dense texture map from several voxel texture maps, each with
+    its own mask of equal shape. Their features are concatenated, with
+    background of each filled with NaN. Nothing is merged in memory before.
+
+    If rcParams.texture_path is set, the dense map is created there on disk.
+    It is written in blocks of whole slices, buffered up to `bufsize` bytes.
+    The file is overwritten, so it must not be open. The returned HDF5
+    dataset keeps it open; the caller closes it by `dense.file.close()`.
+    """
+    assert len(tmaps) == len(masks), (len(tmaps), len(masks))
+    assert all(x.shape == masks[0].shape for x in masks)
     path = dwi.rcParams.texture_path
-    tmap = None
-    for i, (img_slice, mask_slice) in enumerate(zip(img, mask)):
-        if np.count_nonzero(mask_slice):
-            feats, names = call(img_slice, winsize, mask=mask_slice)
-            if tmap is None:
-                shape = img.shape + (len(names),)
-                dtype = dwi.rcParams.texture_dtype
-                if path is None:
-                    tmap = np.full(shape, np.nan, dtype=dtype)
-                else:
-                    s = 'Array is manipulated on disk, it is slow: %s'
-                    logging.warning(s, path)
-                    tmap = dwi.hdf5.create_hdf5(path, shape, dtype,
-                                                fillvalue=np.nan)
-            feats = np.rollaxis(feats, 0, 3)
-            feats[~mask_slice, :] = np.nan  # Fill background with NaN.
-            tmap[i, :, :, :] = feats
-    return tmap, names
-
-
-def average_tmap(tmap, names, mask, mode):
-    """Average texture feature map if requested."""
+    stops = np.cumsum([x.shape[-1] for x in tmaps])
+    columns = [slice(b - x.shape[-1], b) for x, b in zip(tmaps, stops)]
+    shape = masks[0].shape + (int(stops[-1]),)
+    dtype = np.result_type(*tmaps)
+    if path is None:
+        dense = np.full(shape, np.nan, dtype=dtype)
+        for tmap, mask, cols in zip(tmaps, masks, columns):
+            dense[mask, cols] = tmap
+        return dense
+    logging.info('Writing texture map on disk: %s', path)
+    dense = dwi.hdf5.create_hdf5(path, shape, dtype, fillvalue=np.nan,
+                                 fast=True)
+    try:
+        n_slices = max(1, bufsize // (np.prod(shape[1:]) *
+                                      np.dtype(dtype).itemsize))
+        buf = np.empty((n_slices,) + shape[1:], dtype=dtype)
+        starts = [0] * len(tmaps)
+        for i in range(0, len(masks[0]), n_slices):
+            blocks = [x[i:i+n_slices] for x in masks]
+            counts = [np.count_nonzero(x) for x in blocks]
+            if any(counts):
+                a = buf[:len(blocks[0])]
+                a.fill(np.nan)
+                for j, (tmap, block, cols, n) in enumerate(zip(
+                        tmaps, blocks, columns, counts)):
+                    a[block, cols] = tmap[starts[j]:starts[j]+n]
+                    starts[j] += n
+                dense[i:i+len(a), :, :, :] = a
+    except BaseException:
+        dense.file.close()
+        raise
+    return dense
+
+
+def average_tmap(tmap, names, mask, mode, avg=None):
+    """Average texture feature map if requested.
+
+    Texture maps are handled as voxel feature arrays of shape (voxels,
+    features), covering the selected voxels in mask (in the order of
+    `mask.nonzero()`). Without averaging a dense map is returned, see
+    densify_tmap(); otherwise the shape is (1, 1, 1, features).
+
+    Parameter avg is the averaging method ('all', 'mean', or 'median'), by
+    default rcParams.texture_avg. It may also be a sequence of them, in which
+    case a dictionary of texture maps by averaging method is returned. With
+    'voxels' the voxel texture map is returned as it is, for densifying later.
+    """
     assert tmap.shape[-1] == len(names), (tmap.shape[-1], len(names))
+    if not (avg is None or isinstance(avg, str)):
+        return OrderedDict((x, average_tmap(tmap, names, mask, mode, avg=x))
+                           for x in avg)
+    if avg is None:
+        avg = dwi.rcParams.texture_avg
+    if avg == 'voxels':
+        return tmap
     averagers = dict(all=None, mean=np.nanmean, median=np.nanmedian)
-    averager = averagers[dwi.rcParams.texture_avg]
+    averager = averagers[avg]
     dtype = dwi.rcParams.texture_dtype
-    if averager:
-        if mode == 'normal':
-            # Take average of all selected voxels.
-            tmap = tmap[mask, :]
-            assert tmap.ndim == 2
-            tmap = averager(tmap, axis=0)
-            tmap.shape = 1, 1, 1, len(names)
-        elif mode == 'allsame':
-            # It's all the same value.
-            # Feeding np.nanmean whole image hogs too much memory, circumvent.
-            tmap = np.array([averager(x) for x in np.rollaxis(tmap, -1)],
-                            dtype=dtype)
-            tmap.shape = 1, 1, 1, len(names)
-        elif mode == 'slicewise':
-            # Take average of each slice; slice-wise they are the same value.
-            # Feeding np.nanmean whole image hogs too much memory, circumvent.
-            a = np.empty((len(tmap), len(names)), dtype=dtype)
-            for s, p in np.ndindex(a.shape):
-                a[s, p] = averager(tmap[s, :, :, p])
-            tmap = a
-            tmap = averager(tmap, axis=0)
-            tmap.shape = 1, 1, 1, len(names)
-        else:
-            raise ValueError('Invalid averaging mode: {}'.format(mode))
+    if averager is None:
+        return densify_tmap(tmap, mask)
+    if mode in ('normal', 'allsame'):
+        # Take average of all selected voxels (or it's all the same value).
+        tmap = averager(tmap, axis=0)
+    elif mode == 'slicewise':
+        # Take average of each slice; slice-wise they are the same value.
+        slices = mask.nonzero()[0]
+        tmap = [averager(tmap[slices == i], axis=0) for i in
+                np.unique(slices)]
+        tmap = averager(tmap, axis=0)
+    else:
+        raise ValueError('Invalid averaging mode: {}'.format(mode))
+    tmap = np.asarray(tmap, dtype=dtype)
+    tmap.shape = 1, 1, 1, len(names)
     return tmap
 
 
-def get_texture(img, method, winspec, mask):
-    """General texture map layer."""
-    assert img.ndim == 3, img.ndim
+def get_texture(img, method, winspec, mask, avg=None, features=None,
+                params=None):
+    """General texture map layer.
+
+    Parameter avg is the averaging method, see average_tmap(). It may also be
+    a sequence of them, in which case a dictionary of texture maps by
+    averaging method is returned, all averaged from the same calculation.
+
+    Parameter features may be a sequence of the requested features, see
+    feature_key(). They are named like in a full run. Methods in
+    SELECTIVE_METHODS skip the work for other features.
+
+    The image may have a parameter axis last, in which case the features of
+    each parameter are calculated in the same pass, and their names are
+    prefixed with parameter names in params (by default their indices).
+    """
+    tmap, names, mode = _get_tmap(img, method, winspec, mask,
+                                  features=features)
+    names = texture_names(names, winspec, img, params)
+    return average_tmap(tmap, names, mask, mode, avg=avg), names
+
+
+def texture_names(names, winspec, img, params=None):
+    """Prefix method feature names with window specification, and with
+    parameter names for a 4D image.
+    """
+    names = ['{w}-{n}'.format(w=winspec, n=n) for n in names]
+    if img.ndim == 4:
+        names = prefix_params(names, _param_names(img, params))
+    return names
+
+
+def _get_tmap(img, method, winspec, mask, features=None):
+    """Calculate voxel texture map, see get_texture(). Return it with method
+    feature names and averaging mode.
+    """
+    assert img.ndim in (3, 4), img.ndim
     if mask is not None:
         assert mask.dtype == np.bool
-        assert img.shape == mask.shape, (img.shape, mask.shape)
+        assert img.shape[:3] == mask.shape, (img.shape, mask.shape)
     call = METHODS[method]
+    if features is not None and method in SELECTIVE_METHODS:
+        call = partial(call, features=features)
+    if img.ndim == 4:
+        call = partial(_call_params, call)
     if winspec == 'all':
         assert method.endswith('_all')
         tmap, names = get_texture_all(img, call, mask)
-        tmap = average_tmap(tmap, names, mask, 'allsame')
+        mode = 'allsame'
     elif winspec == 'mbb':
         assert method.endswith('_mbb')
         tmap, names = get_texture_mbb(img, call, mask)
-        tmap = average_tmap(tmap, names, mask, 'slicewise')
+        mode = 'slicewise'
     else:
-        tmap, names = get_texture_map(img, call, int(winspec), mask)
-        tmap = average_tmap(tmap, names, mask, 'normal')
-    names = ['{w}-{n}'.format(w=winspec, n=n) for n in names]
-    return tmap, names
+        winsize = int(winspec)
+        tmap, names = get_texture_map(img, call, winsize, mask,
+                                      support=filter_support(method, winsize))
+        mode = 'normal'
+    if features is not None:
+        tmap, names = select_features(tmap, names, features)
+    return tmap, names, mode
+
+
+def _param_names(img, params):
+    """Return parameter names for the last axis of a 4D image."""
+    if params is None:
+        params = [str(i) for i in range(img.shape[-1])]
+    if len(params) != img.shape[-1]:
+        raise ValueError('Parameter names {} do not match image shape '
+                         '{}'.format(params, img.shape))
+    return params
+
+
+def get_textures(img, method, winsizes, masks, avg=None, features=None,
+                 params=None):
+    """Texture map layer for several window sizes of a window method, each
+    with its own mask. Return a list of results like from get_texture().
+
+    Methods in MULTI_METHODS calculate all window sizes in one pass, others
+    are calculated one by one.
+    """
+    if method not in MULTI_METHODS:
+        return [get_texture(img, method, str(w), m, avg=avg,
+                            features=features, params=params)
+                for w, m in zip(winsizes, masks)]
+    assert img.ndim in (3, 4), img.ndim
+    for mask in masks:
+        assert mask.dtype == np.bool
+        assert img.shape[:3] == mask.shape, (img.shape, mask.shape)
+    call = MULTI_METHODS[method]
+    if features is not None and method in SELECTIVE_METHODS:
+        call = partial(call, features=features)
+    if img.ndim == 4:
+        call = partial(_call_params, call)
+    supports = [filter_support(method, w) for w in winsizes]
+    tmaps, names = get_texture_maps(img, call, winsizes, masks, supports)
+    results = []
+    for winsize, mask, tmap, tnames in zip(winsizes, masks, tmaps, names):
+        if features is not None:
+            tmap, tnames = select_features(tmap, tnames, features)
+        tnames = texture_names(tnames, winsize, img, params)
+        results.append((average_tmap(tmap, tnames, mask, 'normal', avg=avg),
+                        tnames))
+    return results
+
+
+def approx_factor(winsize):
+    """Return the downsampling factor and the reduced window size for
+    approximating a texture map of a large window, see get_texture_approx().
+
+    Windows larger than rcParams.texture_approx_winsize (if set) are reduced
+    to an odd window of about that size, otherwise the factor is 1.
+    """
+    target = dwi.rcParams.texture_approx_winsize
+    factor = winsize // target if target else 1
+    if factor < 2:
+        return 1, winsize
+    small = 2 * int(round((winsize / factor - 1) / 2)) + 1
+    return factor, max(small, 3)
+
+
+def _blocks(a, factor, mode='edge'):
+    """Return slices padded to a multiple of factor, reshaped to have blocks
+    of factor * factor voxels on axes 2 and 4.
+    """
+    pad = [(0, 0), (0, -a.shape[1] % factor), (0, -a.shape[2] % factor)]
+    a = np.pad(a, pad + [(0, 0)] * (a.ndim - 3), mode=mode)
+    shape = (a.shape[0], a.shape[1] // factor, factor, a.shape[2] // factor,
+             factor) + a.shape[3:]
+    return a.reshape(shape)
+
+
+def downsample(img, factor):
+    """Downsample image slices by an integer factor, averaging blocks of
+    factor * factor voxels to prevent aliasing. Integer images (like
+    quantized ones) are rounded back to their type.
+    """
+    a = _blocks(img, factor).mean(axis=(2, 4))
+    if np.issubdtype(img.dtype, np.integer):
+        a = np.round(a)
+    return a.astype(img.dtype)
+
+
+def get_texture_approx(img, method, winsize, mask, avg=None, features=None,
+                       params=None):
+    """Approximate texture map layer for a large window, trading accuracy for
+    speed. Return results like get_texture(), and a dictionary of the maximum
+    absolute error of each feature.
+
+    The slices are downsampled by the factor given by approx_factor(), and the
+    features are calculated with the reduced window at the blocks that contain
+    selected voxels. Each selected voxel gets the features of its block, or of
+    the nearest block where the reduced window fits. Note that pixel scale
+    parameters, like GLCM distances and Gabor frequencies, then refer to the
+    reduced resolution.
+
+    The error is measured against exact calculation at up to
+    rcParams.texture_approx_samples selected voxels (NaN if none). For methods
+    that filter whole slices this costs as much as an exact run.
+    """
+    factor, small = approx_factor(winsize)
+    logging.info('Approximating %s-%s at 1/%s resolution with window %s',
+                 method, winsize, factor, small)
+    blocks = _blocks(mask, factor, mode='constant').any(axis=(2, 4))
+    origins = dwi.util.window_origins(blocks.shape, (1, small, small))
+    valid = np.zeros_like(blocks)
+    valid[origins] = blocks[origins]
+    if not np.any(valid):
+        raise ValueError('No windows inside mask: {}'.format(small))
+    tmap, names, _ = _get_tmap(downsample(img, factor), method, str(small),
+                               valid, features=features)
+    # Index of the nearest calculated block, preferably on the same slice.
+    index = np.full(valid.shape, -1, dtype=np.intp)
+    index[valid] = np.arange(np.count_nonzero(valid))
+    sampling = (2 * max(valid.shape), 1, 1)
+    nearest = ndimage.distance_transform_edt(~valid, sampling=sampling,
+                                             return_distances=False,
+                                             return_indices=True)
+    index = index[tuple(nearest)]
+    z, y, x = mask.nonzero()
+    tmap = tmap[index[z, y // factor, x // factor]]
+    names = texture_names(names, winsize, img, params)
+
+    errors = np.full(len(names), np.nan)
+    n = min(dwi.rcParams.texture_approx_samples, len(tmap))
+    if n:
+        indices = np.unique(np.linspace(0, len(tmap) - 1, n).astype(np.intp))
+        samples = np.zeros_like(mask)
+        samples[z[indices], y[indices], x[indices]] = True
+        exact, _, _ = _get_tmap(img, method, str(winsize), samples,
+                                features=features)
+        errors = np.fmax.reduce(np.abs(tmap[indices] - exact), axis=0)
+    errors = OrderedDict(zip(names, errors))
+    return average_tmap(tmap, names, mask, 'normal', avg=avg), names, errors
+
+
+def window_counts(mask, winsize):
+    """Return the number of selected voxels in the window at each selected
+    voxel origin, or -1 where there is no selected voxel or the window does
+    not fit inside the mask, see dwi.util.sliding_window().
+    """
+    mask = np.asanyarray(mask, dtype=bool)
+    counts = np.full(mask.shape, -1, dtype=np.intp)
+    counts[dwi.util.window_origins(mask.shape, winsize)] = \
+        dwi.util.window_sums(mask.astype(np.intp), winsize)
+    counts[~mask] = -1
+    return counts
+
+
+def max_mask(mask, winsize):
+    """Return a mask that has the voxels selected that have the maximum number
+    of surrounding voxels selected in the original mask.
+    """
+    counts = window_counts(mask, winsize)
+    if counts.max() < 0:
+        raise ValueError('No windows inside mask: {}'.format(winsize))
+    return counts == counts.max()
+
+
+def portion_mask(mask, winsize, portion=1, resort_to_max=True):
+    """Return a mask that selects (only) voxels that have the window at each
+    selected voxel origin up to a minimum portion in the original mask selected
+    (1 means the whole window must be selected, 0 gives the original mask).
+
+    If resort_to_max is true, the window with maximum number of selected voxels
+    is used in case the resulting mask would otherwise be empty.
+    """
+    counts = window_counts(mask, winsize)
+    size = np.prod(dwi.util.normalize_sequence(winsize, counts.ndim))
+    r = (counts >= 0) & (counts / size >= portion)
+    if resort_to_max and np.count_nonzero(r) == 0:
+        r = max_mask(mask, winsize)
+    return r
+
+
+class TextureSession:
+    """Texture calculation for one image and mask with several texture
+    specifications.
+
+    Normalization and quantization of the image, and portion masks for each
+    window size are done only once and shared by all methods.
+
+    The image may have several parameters on the last axis. Their features
+    are calculated in the same pass, with names prefixed by parameter name.
+
+    Variables
+    ---------
+    img : ndarray, shape = [depth, height, width(, parameters)]
+        Image.
+    mask : ndarray, shape = [depth, height, width], dtype = bool
+        Mask with selected voxels set to True.
+    mode : ImageMode or str, or a sequence of them for each parameter
+        Imaging mode, used for normalization.
+    portion : float
+        Portion of selected voxels required for each window.
+    params : list of str
+        Parameter names of a 4D image (by default their indices).
+    approx_errors : dict
+        Maximum absolute error of approximated features by name, see
+        get_texture_approx().
+    """
+    def __init__(self, img, mask, mode, portion=0, params=None):
+        if img.shape[:3] != mask.shape or img.ndim not in (3, 4):
+            raise ValueError('Image shape {} does not match mask shape '
+                             '{}'.format(img.shape, mask.shape))
+        self.img = img
+        self.mask = mask
+        self.mode = mode
+        self.portion = portion
+        self.params = None
+        if img.ndim == 4:
+            self.params = _param_names(img, params)
+        self.approx_errors = OrderedDict()
+        self._quantized = None
+        self._pmasks = {}
+
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, self.mode,
+                                   self.img.shape)
+
+    def modes(self):
+        """Return the imaging mode of each parameter."""
+        if isinstance(self.mode, (list, tuple)):
+            if len(self.mode) != len(self.params or [None]):
+                raise ValueError('Need a mode for each parameter: '
+                                 '{}'.format(self.mode))
+            return list(self.mode)
+        return [self.mode] * len(self.params or [None])
+
+    def quantized(self):
+        """Return the normalized and quantized image (for GLCM)."""
+        if self._quantized is None:
+            modes = self.modes()
+            if self.params is None:
+                mode, = modes
+                self._quantized = dwi.util.normalize_quantize(self.img, mode)
+            else:
+                self._quantized = np.empty(self.img.shape, dtype=np.uint8)
+                for i, mode in enumerate(modes):
+                    dwi.util.normalize_quantize(self.img[..., i], mode,
+                                                out=self._quantized[..., i])
+        return self._quantized
+
+    def image(self, method):
+        """Return the image for a texture method. It is shared by all methods,
+        so it is given as a read-only view.
+        """
+        if method in ('glcm', 'glcm_mbb'):
+            img = self.quantized()
+        else:
+            img = np.asarray(self.img)
+        img = img.view()
+        img.flags.writeable = False
+        return img
+
+    def portion_mask(self, winspec):
+        """Return the portion mask for a window specification."""
+        winspec = str(winspec)
+        if winspec not in self._pmasks:
+            if winspec in ('all', 'mbb'):
+                pmask = self.mask  # Some methods don't use window.
+            elif winspec.isdigit():
+                winsize = int(winspec)
+                assert winsize > 0
+                winshape = (1, winsize, winsize)
+                pmask = portion_mask(self.mask, winshape,
+                                     portion=self.portion)
+            else:
+                raise ValueError('Invalid window spec: {}'.format(winspec))
+            self._pmasks[winspec] = pmask
+        return self._pmasks[winspec]
+
+    def texture(self, tspec, avg=None):
+        """Calculate texture map for a TextureSpec. See get_texture() for
+        parameter avg. If the TextureSpec has a feature, only it is
+        calculated.
+        """
+        features = None if tspec.feature is None else [tspec.feature]
+        return self.method_textures(tspec.method, [tspec.winsize],
+                                    features=features, avg=avg)[0]
+
+    def method_textures(self, method, winspecs, features=None, avg=None):
+        """Calculate texture maps for several window specifications of
+        a method, in one pass if possible. See get_textures().
+        """
+        logging.info('Calculating %s texture features for %s (%s)...', method,
+                     self.mode, ' '.join(str(x) for x in winspecs))
+        img = self.image(method)
+        winspecs = [str(x) for x in winspecs]
+        if all(x.isdigit() for x in winspecs):
+            approx = [x for x in winspecs if self.approx_factor(method, x) > 1]
+            exact = [x for x in winspecs if x not in approx]
+            results = {}
+            if exact:
+                winsizes = [int(x) for x in exact]
+                masks = [self.portion_mask(x) for x in exact]
+                results.update(zip(exact, get_textures(
+                    img, method, winsizes, masks, avg=avg, features=features,
+                    params=self.params)))
+            for x in approx:
+                tmap, names, errors = get_texture_approx(
+                    img, method, int(x), self.portion_mask(x), avg=avg,
+                    features=features, params=self.params)
+                self.approx_errors.update(errors)
+                results[x] = tmap, names
+            return [results[x] for x in winspecs]
+        return [get_texture(img, method, x, self.portion_mask(x), avg=avg,
+                            features=features, params=self.params)
+                for x in winspecs]
+
+    def approx_factor(self, method, winspec):
+        """Return the downsampling factor used for a method and window
+        specification, 1 if it is calculated exactly. See approx_factor().
+        """
+        winspec = str(winspec)
+        if method in APPROX_METHODS and winspec.isdigit():
+            return approx_factor(int(winspec))[0]
+        return 1
+
+    def textures(self, tspecs, avg=None):
+        """Calculate texture maps for several TextureSpecs, merged into one
+        map. Feature names are aggregated in order. See get_texture() for
+        parameter avg.
+
+        Each method and window specification is calculated once, for the
+        features requested by any TextureSpec (all, if any has no feature).
+        Window sizes of methods in MULTI_METHODS are calculated together.
+
+        Voxel outputs ('all') are densified once from the voxel texture maps
+        of all TextureSpecs, see densify_tmaps().
+        """
+        single = avg is None or isinstance(avg, str)
+        avgs = [avg] if single else list(avg)
+        if single and avg is None:
+            avgs = [dwi.rcParams.texture_avg]
+        # Voxel maps are densified after merging.
+        calc_avgs = ['voxels' if x == 'all' else x for x in avgs]
+        # Requested features by method and window specification.
+        groups = OrderedDict()
+        for tspec in tspecs:
+            d = groups.setdefault(tspec.method, OrderedDict())
+            winspec = str(tspec.winsize)
+            features = d.setdefault(winspec, [])
+            if features is None:
+                continue
+            if tspec.feature is None:
+                d[winspec] = None
+            elif tspec.feature not in features:
+                features.append(tspec.feature)
+        results = {}
+        for method, d in groups.items():
+            if method in MULTI_METHODS:
+                batches = [list(d.keys())]
+            else:
+                batches = [[x] for x in d.keys()]
+            for winspecs in batches:
+                features = [d[x] for x in winspecs]
+                if None in features:
+                    features = None
+                else:
+                    features = list(OrderedDict.fromkeys(sum(features, [])))
+                results.update(((method, x), r) for x, r in zip(
+                    winspecs, self.method_textures(method, winspecs,
+                                                   features=features,
+                                                   avg=calc_avgs)))
+        tmaps = OrderedDict((x, []) for x in calc_avgs)
+        names = []
+        for tspec in tspecs:
+            d, tnames = results[(tspec.method, str(tspec.winsize))]
+            if tspec.feature is not None:
+                indices = [i for i, x in enumerate(tnames) if
+                           feature_key(x) == tspec.feature]
+                d = OrderedDict((k, v[..., indices]) for k, v in d.items())
+                tnames = [tnames[i] for i in indices]
+            for k, v in d.items():
+                tmaps[k].append(v)
+            names.extend(tnames)
+        for k, v in tmaps.items():
+            if k == 'voxels':
+                masks = [self.portion_mask(x.winsize) for x in tspecs]
+                tmaps[k] = densify_tmaps(v, masks)
+            else:
+                tmaps[k] = v[0] if len(v) == 1 else np.concatenate(v, axis=-1)
+        tmaps = OrderedDict((x, tmaps[y]) for x, y in zip(avgs, calc_avgs))
+        if single:
+            return tmaps[avgs[0]], names
+        return tmaps, names
+
+    def n_windows(self, tspec):
+        """Return the number of windows (or voxels) used for a TextureSpec."""
+        return np.count_nonzero(self.portion_mask(tspec.winsize))
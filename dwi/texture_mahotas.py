@@ -1,6 +1,8 @@
 """Texture code relying on Mahotas library."""
 
 from collections import OrderedDict
+from functools import lru_cache
+from math import factorial
 
 import numpy as np
 from scipy import ndimage
@@ -26,17 +28,58 @@ def zernike(img, radius, degree=8, cm=None):
     return feats
 
 
+@lru_cache(maxsize=None)
+def zernike_basis(winsize, degree):
+    """Zernike polynomial basis for window, cached.
+
+    The unit disc is centered at (radius, radius) like in zernike_map(), with
+    radius `winsize // 2`. Kernels are ordered like the moments returned by
+    mahotas, and include the normalization factor `(n + 1) / pi`. Return
+    complex kernels of shape (moments, winsize, winsize), and the disc.
+    """
+    radius = winsize // 2
+    y, x = (np.indices((winsize, winsize), dtype=np.double) - radius) / radius
+    d = np.hypot(x, y)
+    disc = d <= 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = np.where(d > 0, (x + 1j * y) / d, 0)
+    kernels = []
+    for n in range(degree + 1):
+        for l in range(n + 1):
+            if (n - l) % 2 == 0:
+                r = sum((-1)**m * factorial(n - m) /
+                        (factorial(m) * factorial((n - 2 * m + l) // 2) *
+                         factorial((n - 2 * m - l) // 2)) * d**(n - 2 * m)
+                        for m in range((n - l) // 2 + 1))
+                kernels.append((n + 1) / np.pi * r * a**l)
+    kernels = np.array(kernels)
+    kernels[:, ~disc] = 0
+    kernels.flags.writeable = False
+    disc.flags.writeable = False
+    return kernels, disc
+
+
 def zernike_map(img, winsize, mask=None, output=None):
-    """Zernike moment map."""
+    """Zernike moment map.
+
+    Moments of all windows are calculated in one go with a precalculated
+    polynomial basis, see zernike_basis(). Like in mahotas, only positive
+    pixels are taken into account, weighted by their proportion within disc.
+    """
     degree = dwi.rcParams.texture_zernike_degree
-    radius = winsize // 2
-    for pos, win in dwi.util.sliding_window(img, winsize, mask=mask):
-        feats = zernike(win, radius, degree=degree, cm=(radius, radius))
-        if output is None:
-            dtype = dwi.rcParams.texture_dtype
-            output = np.zeros((len(feats),) + img.shape, dtype=dtype)
-        for i, v in enumerate(feats):
-            output[(i,) + pos] = v
+    img = np.asarray(img, dtype=np.float32).astype(np.double)
+    img[~(img > 0)] = 0
+    basis, disc = zernike_basis(winsize, degree)
+    kernels = np.concatenate((basis, disc[np.newaxis]))
+    origins, products = dwi.util.window_dot(img, kernels, mask=mask)
+    moments, totals = products[:-1], products[-1].real
+    feats = np.zeros(moments.shape)
+    nonzero = totals > 0
+    feats[:, nonzero] = np.abs(moments[:, nonzero]) / totals[nonzero]
+    if output is None:
+        dtype = dwi.rcParams.texture_dtype
+        output = np.zeros((len(feats),) + img.shape, dtype=dtype)
+    output[(slice(None),) + origins] = feats
     names = ['zernike({})'.format(i) for i in range(len(feats))]
     return output, names
 
@@ -81,30 +124,73 @@ def haar_features(win):
     return d
 
 
-def haar_map(img, winsize, mask=None, output=None):
-    """Haar texture feature map."""
+def haar_map(img, winsize, mask=None, output=None, features=None):
+    """Haar texture feature map, see haar_maps()."""
+    return haar_maps(img, [winsize], masks=[mask], features=features)[0]
+
+
+def haar_maps(img, winsizes, masks=None, features=None):
+    """Haar texture feature maps for several window sizes. Return a list of
+    (output, names) for each.
+
+    Window features are calculated for all windows at once by box filtering
+    each coefficient band, its absolute values, and its squares. The
+    transform and these planes are shared by all window sizes. Parameter
+    features may list the features to calculate, then only the needed levels
+    and bands are processed.
+    """
+    if masks is None:
+        masks = [None] * len(winsizes)
     nlevels = dwi.rcParams.texture_haar_levels
-    # Cannot have nans here, they might have global influence.
+    featnames = ('aav', 'std')
+    # Keys (level, coefficient band, feature), one-based.
+    keys = [(i, j, k) for i in range(1, nlevels + 1) for j in range(1, 4)
+            for k in featnames]
+    s = 'haar({},{},{})'
+    if features is not None:
+        keys = [x for x in keys if dwi.texture.feature_key(s.format(*x)) in
+                features]
+        if not keys:
+            raise ValueError('No Haar features selected: {}'.format(
+                features))
+    names = [s.format(*x) for x in keys]
+    # Cannot have nans here, they might have global influence. The input is
+    # shared with other methods, so it is not modified.
     nans = np.isnan(img)
     if np.count_nonzero(nans):
-        img[nans] = 0  # XXX: Replace with minimum value instead?
-    levels = haar_levels(img, nlevels, drop_approx=True)
-    names = []
-    for i, coeffs in enumerate(levels):
-        for j, coeff in enumerate(coeffs):
-            for pos, win in dwi.util.sliding_window(coeff, winsize, mask):
-                feats = haar_features(win)
-                if output is None:
-                    dtype = dwi.rcParams.texture_dtype
-                    output = np.zeros((len(levels), len(coeffs), len(feats),) +
-                                      coeff.shape, dtype=dtype)
-                for k, v in enumerate(feats.values()):
-                    output[(i, j, k,) + pos] = v
-            s = 'haar({level},{coeff},{feat})'
-            names += [s.format(level=i+1, coeff=j+1, feat=k) for k in
-                      feats.keys()]
-    output.shape = (-1,) + levels[0][0].shape
-    return output, names
+        img = np.where(nans, 0, img)  # XXX: Replace with minimum value?
+    levels = haar_levels(img, max(x[0] for x in keys), drop_approx=True)
+    shape = levels[0][0].shape
+    # Planes to average for each band and feature.
+    planes = OrderedDict()
+    for i, j, k in keys:
+        coeff = levels[i-1][j-1]
+        if k == 'aav':
+            planes[(i, j, k)] = [np.abs(coeff)]
+        else:
+            planes[(i, j, k)] = [coeff, np.square(coeff)]
+    dtype = dwi.rcParams.texture_dtype
+    results = []
+    for winsize, mask in zip(winsizes, masks):
+        winshape = dwi.util.normalize_sequence(winsize, len(shape))
+        origins = dwi.util.window_origins(shape, winshape)
+        if mask is not None:
+            # Pruned borders are left out.
+            selected = np.asarray(mask)[:shape[0], :shape[1]][origins]
+        output = np.zeros((len(keys),) + shape, dtype=dtype)
+        for i, key in enumerate(keys):
+            means = [dwi.util.window_means(x, winshape) for x in planes[key]]
+            if key[2] == 'aav':
+                feat, = means
+            else:
+                mean, sqmean = means
+                feat = np.sqrt(np.maximum(sqmean - mean**2, 0))
+            if mask is None:
+                output[(i,) + origins] = feat
+            else:
+                output[(i,) + origins][selected] = feat[selected]
+        results.append((output, list(names)))
+    return results
 
 
 # Haralick (never used this because of those weird eigenvalue errors)
@@ -144,10 +230,9 @@ def haralick_map(img, winsize, mask=None, output=None, ignore_zeros=False):
 def haralick_mbb(img, mask):
     """Haralick features for selected area inside minimum bounding box."""
     positions = dwi.util.bounding_box(mask)
-    slices = [slice(*t) for t in positions]
-    img = img[slices]
+    slices = tuple(slice(*t) for t in positions)
     mask = mask[slices]
-    img[~mask] = 0
+    img = np.where(mask, img[slices], 0).astype(img.dtype)
     feats, names = haralick(img, ignore_zeros=True)
     names = ['haralick({i}-{n})'.format(i=i+1, n=dwi.util.abbrev(n))
              for i, n in enumerate(names)]
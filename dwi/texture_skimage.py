@@ -1,9 +1,11 @@
 """Texture code relying on Scikit-image library."""
 
 from collections import OrderedDict
+from functools import lru_cache
 from itertools import product
 
 import numpy as np
+from scipy import ndimage
 import skimage.feature
 import skimage.filters
 import skimage.measure
@@ -25,7 +27,7 @@ def get_angles(n):
 # Grey-Level Co-Occurrence Matrix (GLCM) features
 
 
-def glcm_props(img, ignore_zeros=False):
+def glcm_props(img, ignore_zeros=False, features=None):
     """Grey-level co-occurrence matrix (GLCM) texture features.
 
     Include the six features provided by scikit-image. Calculate mean and range
@@ -34,8 +36,9 @@ def glcm_props(img, ignore_zeros=False):
     Add an alternative approach for orientation invariance (feature 'alt', see
     Vignati et al. 2015: Texture features on T2-weighted magnetic resonance
     imaging: new potential biomarkers for prostate cancer aggressiveness).
+
+    Parameter features may list the features to calculate, see glcm_keys().
     """
-    names = dwi.rcParams.texture_glcm_names
     distances = dwi.rcParams.texture_glcm_distances
     assert img.ndim == 2, img.shape
     assert img.dtype == np.uint8, img.dtype
@@ -44,50 +47,352 @@ def glcm_props(img, ignore_zeros=False):
     # distances = [x for x in distances if x <= min(img.shape)-1]
     max_distance = np.sqrt(img.shape[0]**2 + img.shape[1]**2) - 1
     distances = [x for x in distances if x <= max_distance]
+    keys = glcm_keys(distances, features)
+    distances = [x for x in distances if any(k[1] == x for k in keys)]
     angles = get_angles(4)
     levels = img.max() + 1
     glcm = skimage.feature.greycomatrix(img, distances, angles, levels,
-                                        symmetric=True, normed=True)
-    if ignore_zeros and np.min(img) == 0:
-        # Drop information on the first grey-level if it's zero (background).
-        glcm = glcm[1:, 1:, ...]
-    glcm_mean = np.mean(glcm, axis=3, keepdims=True)
+                                        symmetric=True)
+    feats = glcm_stack_props(glcm[np.newaxis], distances,
+                             ignore_zeros=ignore_zeros, keys=keys)
+    return OrderedDict((k, feats[k][0]) for k in keys)
+
+
+def glcm_keys(distances, features=None):
+    """Return GLCM feature keys (property, distance, variant) in calculation
+    order, for all or only requested features. Features are named as in
+    dwi.texture.feature_key(), e.g. 'contrast,2,mean'.
+    """
+    keys = [(name, dist, variant) for name in dwi.rcParams.texture_glcm_names
+            for dist in distances for variant in ('mean', 'range', 'alt')]
+    if features is not None:
+        keys = [k for k in keys if dwi.texture.feature_key(
+            translate_name('glcm{}'.format(k))) in features]
+        if not keys:
+            raise ValueError('No GLCM features selected: {}'.format(features))
+    return keys
+
+
+def glcm_matrix_props(glcm, names):
+    """GLCM properties for a stack of co-occurrence matrices.
+
+    The stack is shaped as (windows, levels, levels, distances, angles), and
+    each property as (windows, distances, angles). Properties are defined as
+    in greycoprops(), each matrix is normalized first.
+    """
+    sums = np.sum(glcm, axis=(1, 2), keepdims=True)
+    sums[sums == 0] = 1
+    glcm = glcm / sums
+    levels = glcm.shape[1]
+    I, J = np.ogrid[0:levels, 0:levels]
+    ones = np.ones((levels, levels))
+    weights = np.array([
+        (I - J)**2 * ones,  # Contrast.
+        np.abs(I - J) * ones,  # Dissimilarity.
+        1 / (1 + (I - J)**2) * ones,  # Homogeneity.
+        I * ones,  # Correlation: means.
+        J * ones,
+        I**2 * ones,  # Correlation: second moments.
+        J**2 * ones,
+        I * J * ones,  # Correlation: cross moment.
+        ])
+    sums = np.tensordot(weights, glcm, axes=([1, 2], [1, 2]))
+    contrast, dissim, homog, mean_i, mean_j, m2_i, m2_j, m11 = sums
+    asm = np.einsum('nijda,nijda->nda', glcm, glcm)
     d = OrderedDict()
     for name in names:
-        # Returns array of features indexed by (distance, angle).
-        feats = skimage.feature.greycoprops(glcm, name)
-        feats_alt = skimage.feature.greycoprops(glcm_mean, name)
-        angular_means = np.mean(feats, axis=1)
-        angular_ranges = np.ptp(feats, axis=1)
-        for dist, am, ar, alt in zip(distances, angular_means, angular_ranges,
-                                     feats_alt):
-            d[(name, dist, 'mean')] = am
-            d[(name, dist, 'range')] = ar
-            d[(name, dist, 'alt')] = alt
+        if name == 'contrast':
+            d[name] = contrast
+        elif name == 'dissimilarity':
+            d[name] = dissim
+        elif name == 'homogeneity':
+            d[name] = homog
+        elif name == 'ASM':
+            d[name] = asm
+        elif name == 'energy':
+            d[name] = np.sqrt(asm)
+        elif name == 'correlation':
+            std_i = np.sqrt(np.maximum(m2_i - mean_i**2, 0))
+            std_j = np.sqrt(np.maximum(m2_j - mean_j**2, 0))
+            cov = m11 - mean_i * mean_j
+            # Handle the special case of standard deviations near zero.
+            flat = (std_i < 1e-15) | (std_j < 1e-15)
+            result = np.ones_like(cov)
+            result[~flat] = cov[~flat] / (std_i[~flat] * std_j[~flat])
+            d[name] = result
+        else:
+            raise ValueError('Invalid GLCM property: {}'.format(name))
     return d
 
 
-def glcm_map(img, winsize, mask=None, output=None, ignore_zeros=False):
-    """Grey-level co-occurrence matrix (GLCM) texture feature map."""
-    for pos, win in dwi.util.sliding_window(img, winsize, mask=mask):
-        feats = glcm_props(win, ignore_zeros=ignore_zeros)
-        if output is None:
-            dtype = dwi.rcParams.texture_dtype
-            output = np.zeros((len(feats),) + img.shape, dtype=dtype)
-        for i, value in enumerate(feats.values()):
-            output[(i,) + pos] = value
-    names = [translate_name('glcm{}'.format(t)) for t in feats.keys()]
+def glcm_stack_props(glcm, distances, ignore_zeros=False, chunksize=64,
+                     keys=None):
+    """GLCM features for a stack of co-occurrence matrices, see glcm_props().
+
+    Parameter glcm is shaped as (windows, levels, levels, distances, 4 angles),
+    it may hold counts in compact integer type. Matrices are converted to
+    floating point in chunks of windows to limit memory use. Returns an
+    OrderedDict of feature arrays, keyed like in glcm_props(). Parameter keys
+    may list the features to calculate, see glcm_keys().
+    """
+    if keys is None:
+        keys = glcm_keys(distances)
+    names = [x for x in dwi.rcParams.texture_glcm_names if
+             any(k[0] == x for k in keys)]
+    alt = any(k[2] == 'alt' for k in keys)
+    assert glcm.ndim == 5 and glcm.shape[3] == len(distances), glcm.shape
+    n = len(glcm)
+    d = OrderedDict((k, np.empty(n)) for k in keys)
+    for start in range(0, n, chunksize):
+        chunk = glcm[start:start+chunksize].astype(np.float64)
+        sums = np.sum(chunk, axis=(1, 2), keepdims=True)
+        sums[sums == 0] = 1
+        chunk /= sums
+        if ignore_zeros:
+            # Drop information on the first grey-level (background). Zeroing
+            # it does the same, properties do not depend on level shift.
+            chunk[:, 0, :, ...] = 0
+            chunk[:, :, 0, ...] = 0
+        props = glcm_matrix_props(chunk, names)
+        if alt:
+            chunk_mean = np.mean(chunk, axis=4, keepdims=True)
+            props_alt = glcm_matrix_props(chunk_mean, names)
+        s = slice(start, start + len(chunk))
+        for name, dist, variant in keys:
+            # Arrays of features indexed by (window, distance, angle).
+            i = distances.index(dist)
+            if variant == 'mean':
+                feats = np.mean(props[name][:, i], axis=1)
+            elif variant == 'range':
+                feats = np.ptp(props[name][:, i], axis=1)
+            else:
+                feats = props_alt[name][:, i, 0]
+            d[(name, dist, variant)][s] = feats
+    return d
+
+
+def glcm_offsets(distances, angles):
+    """Return pixel pair offsets (row, column) for each distance and angle, in
+    the same order and with the same rounding as in greycomatrix().
+    """
+    return [(int(round(np.sin(a) * d)), int(round(np.cos(a) * d)))
+            for d in distances for a in angles]
+
+
+def glcm_window_rows(img, winshape, offsets, levels, mask=None):
+    """Incremental sliding-window grey-level co-occurrence counts.
+
+    Process one row of window positions at a time. Pixel pairs starting at each
+    column of the row band are counted once; as the window slides along the
+    row, the pairs of the entering column are added and those of the leaving
+    column removed (by differencing cumulative column counts). Pairs are
+    counted as unordered, which is all a symmetric GLCM needs, and only the
+    pair codes present in the band are kept, so no full matrix is built for
+    any window.
+
+    Yields origin row, origin columns, the sorted codes, and their counts
+    shaped as (windows, codes), for the windows whose origin is selected in
+    mask. Each code is offset * levels**2 + a * levels + b, with grey-levels
+    a <= b.
+    """
+    height, width = img.shape
+    wh, ww = winshape
+    dcs = np.array([dc for _, dc in offsets])
+    img = img.astype(np.intp)
+    for top in range(height - wh + 1):
+        y = top + wh // 2
+        lefts = np.arange(width - ww + 1)
+        if mask is not None:
+            lefts = lefts[mask[y, lefts + ww // 2]]
+        if not len(lefts):
+            continue
+        # Columns covered by the selected windows on this row.
+        cl, cr = lefts[0], lefts[-1] + ww
+        cols, codes = [], []
+        for o, (dr, dc) in enumerate(offsets):
+            r0, r1 = top + max(0, -dr), top + wh - max(0, dr)
+            c0, c1 = cl + max(0, -dc), cr - max(0, dc)
+            if r0 >= r1 or c0 >= c1:
+                continue
+            first = img[r0:r1, c0:c1]
+            second = img[r0+dr:r1+dr, c0+dc:c1+dc]
+            pairs = np.minimum(first, second) * levels
+            pairs += np.maximum(first, second)
+            codes.append((o * levels**2 + pairs).ravel())
+            cols.append(np.broadcast_to(np.arange(c0 - cl, c1 - cl),
+                                        first.shape).ravel())
+        if not codes:
+            counts = np.zeros((len(lefts), 0), dtype=np.uint8)
+            yield y, lefts + ww // 2, np.zeros(0, dtype=np.intp), counts
+            continue
+        codes, inverse = np.unique(np.concatenate(codes), return_inverse=True)
+        n_codes = len(codes)
+        colcounts = np.bincount(np.concatenate(cols) * n_codes + inverse,
+                                minlength=(cr - cl) * n_codes)
+        # Compact unsigned type that holds the band total of any code.
+        dtype = np.min_scalar_type(len(inverse))
+        colcounts = colcounts.reshape(cr - cl, n_codes).astype(dtype)
+        cumcounts = np.zeros((cr - cl + 1, n_codes), dtype=dtype)
+        np.cumsum(colcounts, axis=0, out=cumcounts[1:])
+        # Column range of pair starts within window, for each code.
+        dc = dcs[codes // levels**2]
+        first = np.maximum(0, -dc)
+        last = np.maximum(first, ww - np.maximum(0, dc))
+        x = (lefts - cl)[:, np.newaxis]
+        i = np.arange(n_codes)
+        counts = cumcounts[x + last, i] - cumcounts[x + first, i]
+        yield y, lefts + ww // 2, codes, counts
+
+
+def group_sums(x, groups, n_groups):
+    """Sum the columns of x by sorted group indices into (rows, n_groups)."""
+    sums = np.zeros((len(x), n_groups), dtype=x.dtype)
+    if len(groups):
+        starts = np.flatnonzero(np.r_[True, np.diff(groups) != 0])
+        sums[:, groups[starts]] = np.add.reduceat(x, starts, axis=1)
+    return sums
+
+
+def glcm_pair_props(x, groups, pairs, n_groups, levels, names):
+    """GLCM properties of stacked, grouped unordered-pair histograms.
+
+    Each column of x (windows, codes) holds the mass of grey-level pair
+    (a, b), a <= b, in the symmetric GLCM of its group; the columns are sorted
+    by group. Returns an OrderedDict of properties shaped as (windows,
+    groups), defined as in greycoprops() for the corresponding normalized
+    symmetric matrices.
+    """
+    a, b = np.divmod(pairs, levels)
+    a, b = a.astype(np.float64), b.astype(np.float64)
+
+    def gsum(weights):
+        """Sum weighted pair masses in each group."""
+        return group_sums(x * weights, groups, n_groups)
+
+    total = gsum(1)
+    total[total == 0] = 1
+    d = OrderedDict()
+    for name in names:
+        if name == 'contrast':
+            d[name] = gsum((a - b)**2) / total
+        elif name == 'dissimilarity':
+            d[name] = gsum(np.abs(a - b)) / total
+        elif name == 'homogeneity':
+            d[name] = gsum(1 / (1 + (a - b)**2)) / total
+        elif name in ('ASM', 'energy'):
+            # Off-diagonal pairs appear twice in the symmetric matrix.
+            asm = gsum(x * np.where(a == b, 2., 1.)) / (2 * total**2)
+            d[name] = asm if name == 'ASM' else np.sqrt(asm)
+        elif name == 'correlation':
+            mean = gsum(a + b) / (2 * total)
+            var = np.maximum(gsum(a**2 + b**2) / (2 * total) - mean**2, 0)
+            cov = gsum(a * b) / total - mean**2
+            # Handle the special case of standard deviations near zero.
+            flat = var < 1e-30
+            result = np.ones_like(cov)
+            result[~flat] = cov[~flat] / var[~flat]
+            d[name] = result
+        else:
+            raise ValueError('Invalid GLCM property: {}'.format(name))
+    return d
+
+
+def glcm_counts_props(codes, counts, offsets, winshape, levels, n_dist,
+                      ignore_zeros=False, names=None, alt=True):
+    """GLCM features from windowed co-occurrence counts, as in glcm_props().
+
+    Parameters codes and counts are as yielded by glcm_window_rows(). Returns
+    an OrderedDict of feature values for each window, keyed by (property,
+    distance index, variant). Parameter names may list the properties, and
+    alt tells whether to calculate the 'alt' variant.
+    """
+    if names is None:
+        names = dwi.rcParams.texture_glcm_names
+    n_off = len(offsets)
+    n_angles = n_off // n_dist
+    offset_indices, pairs = np.divmod(codes, levels**2)
+    x = counts.astype(np.float64)
+    if ignore_zeros:
+        # Dropping the first grey-level from the normalized matrices; the
+        # properties do not depend on the level shift.
+        x[:, pairs // levels == 0] = 0
+    props = glcm_pair_props(x, offset_indices, pairs, n_off, levels, names)
+    d = OrderedDict()
+    for name in names:
+        feats = props[name].reshape((len(x), n_dist, n_angles))
+        angular_means = np.mean(feats, axis=2)
+        angular_ranges = np.ptp(feats, axis=2)
+        for i in range(n_dist):
+            d[(name, i, 'mean')] = angular_means[:, i]
+            d[(name, i, 'range')] = angular_ranges[:, i]
+    if not alt:
+        return d
+    # Mean matrix over angles, each normalized by its total number of pairs
+    # (offsets that do not fit in window have an all-zero matrix).
+    n_pairs = [max(0, winshape[0] - abs(dr)) * max(0, winshape[1] - abs(dc))
+               for dr, dc in offsets]
+    weights = np.array([1 / n if n else 0 for n in n_pairs])
+    alt_codes = offset_indices // n_angles * levels**2 + pairs
+    order = np.argsort(alt_codes, kind='stable')
+    alt_codes = alt_codes[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(alt_codes) != 0])
+    x_alt = np.add.reduceat(x[:, order] * weights[offset_indices[order]],
+                            starts, axis=1)
+    alt_dists, alt_pairs = np.divmod(alt_codes[starts], levels**2)
+    props_alt = glcm_pair_props(x_alt, alt_dists, alt_pairs, n_dist, levels,
+                                names)
+    for name in names:
+        for i in range(n_dist):
+            d[(name, i, 'alt')] = props_alt[name][:, i]
+    return d
+
+
+def glcm_map(img, winsize, mask=None, output=None, ignore_zeros=False,
+             features=None):
+    """Grey-level co-occurrence matrix (GLCM) texture feature map.
+
+    Co-occurrence counts are maintained incrementally while the window slides,
+    see glcm_window_rows(). Features equal those of glcm_props() for each
+    window. Parameter features may list the features to calculate, then only
+    the needed distances, properties, and variants are processed.
+    """
+    assert img.ndim == 2, img.shape
+    assert img.dtype == np.uint8, img.dtype
+    winshape = dwi.util.normalize_sequence(winsize, img.ndim)
+    if not all(0 < w <= i for w, i in zip(winshape, img.shape)):
+        raise ValueError('Invalid window shape: {}'.format(winshape))
+    distances = dwi.rcParams.texture_glcm_distances
+    max_distance = np.sqrt(winshape[0]**2 + winshape[1]**2) - 1
+    distances = [x for x in distances if x <= max_distance]
+    keys = glcm_keys(distances, features)
+    names = [x for x in dwi.rcParams.texture_glcm_names if
+             any(k[0] == x for k in keys)]
+    distances = [x for x in distances if any(k[1] == x for k in keys)]
+    alt = any(k[2] == 'alt' for k in keys)
+    angles = get_angles(4)
+    offsets = glcm_offsets(distances, angles)
+    levels = int(img.max()) + 1
+    if output is None:
+        dtype = dwi.rcParams.texture_dtype
+        output = np.zeros((len(keys),) + img.shape, dtype=dtype)
+    for y, xs, codes, counts in glcm_window_rows(img, winshape, offsets,
+                                                 levels, mask=mask):
+        feats = glcm_counts_props(codes, counts, offsets, winshape, levels,
+                                  len(distances), ignore_zeros=ignore_zeros,
+                                  names=names, alt=alt)
+        for i, (name, dist, variant) in enumerate(keys):
+            output[i, y, xs] = feats[(name, distances.index(dist), variant)]
+    names = [translate_name('glcm{}'.format(k)) for k in keys]
     return output, names
 
 
-def glcm_mbb(img, mask):
+def glcm_mbb(img, mask, features=None):
     """Single GLCM features for selected area inside minimum bounding box."""
     positions = dwi.util.bounding_box(mask)
-    slices = [slice(*t) for t in positions]
-    img = img[slices]
+    slices = tuple(slice(*t) for t in positions)
     mask = mask[slices]
-    img[~mask] = 0
-    feats = glcm_props(img, ignore_zeros=True)
+    img = np.where(mask, img[slices], 0).astype(img.dtype)
+    feats = glcm_props(img, ignore_zeros=True, features=features)
     output = list(feats.values())
     names = [translate_name('glcm{}'.format(t)) for t in feats.keys()]
     return output, names
@@ -97,24 +402,46 @@ def glcm_mbb(img, mask):
 
 
 def lbp_freq_map(img, winsize, mask=None):
-    """Local Binary Pattern (LBP) frequency histogram map."""
+    """Local Binary Pattern (LBP) frequency histogram map, see
+    lbp_freq_maps().
+    """
+    return lbp_freq_maps(img, [winsize], masks=[mask])[0]
+
+
+def lbp_freq_maps(img, winsizes, masks=None):
+    """Local Binary Pattern (LBP) frequency histogram maps for several window
+    sizes. Return a list of (output, names) for each.
+
+    Code frequencies of all windows are obtained at once from the integral
+    images of one-hot code planes. LBP radius is half the window size; window
+    sizes with the same radius share the codes and integral images.
+    """
+    if masks is None:
+        masks = [None] * len(winsizes)
     neighbours = dwi.rcParams.texture_lbp_neighbours
-    radius = winsize // 2
     n = neighbours + 2
-    freqs = skimage.feature.local_binary_pattern(img, neighbours, radius,
-                                                 method='uniform')
-    assert freqs.max() == n - 1, freqs.max()
-    output = np.zeros((n,) + img.shape, dtype=np.float32)
-    # for i, a in enumerate(output):
-    #     a[:, :] = (freqs == i)
-    for origin, win in dwi.util.sliding_window(freqs, winsize, mask=mask):
-        for i in range(n):
-            output[i][origin] = np.count_nonzero(win == i) / win.size
-    assert len(output) == n, output.shape
-    names = ['lbp({r},{i})'.format(r=radius, i=i) for i in range(n)]
-    # if mask is not None:
-    #     output[:, ~mask] = 0
-    return output, names
+    sats = {}
+    results = []
+    for winsize, mask in zip(winsizes, masks):
+        radius = winsize // 2
+        if radius not in sats:
+            freqs = skimage.feature.local_binary_pattern(img, neighbours,
+                                                         radius,
+                                                         method='uniform')
+            assert freqs.max() <= n - 1, freqs.max()
+            planes = freqs.astype(np.intp) == np.arange(n).reshape((n, 1, 1))
+            sats[radius] = dwi.util.integral_image(planes, dtype=np.int32)
+        output = np.zeros((n,) + img.shape, dtype=np.float32)
+        winshape = dwi.util.normalize_sequence(winsize, img.ndim)
+        counts = dwi.util.window_sums(None, [1] + winshape, sat=sats[radius])
+        origins = (slice(None),) + dwi.util.window_origins(img.shape, winshape)
+        output[origins] = counts / np.prod(winshape)
+        if mask is not None:
+            output[:, ~mask] = 0
+        assert len(output) == n, output.shape
+        names = ['lbp({r},{i})'.format(r=radius, i=i) for i in range(n)]
+        results.append((output, names))
+    return results
 
 
 # Gabor features
@@ -157,17 +484,43 @@ def gabor(img):
     return d
 
 
-def gabor_featmap(real, imag, winsize, mask):
-    """Get Gabor feature map of shape (feats, height, width) from the filtered
-    image.
+def gabor_planes(real, imag, names=GABOR_FEAT_NAMES):
+    """Get the planes that Gabor window features are averaged from: real
+    part, its square, its absolute value, and magnitude. Planes not needed for
+    the named features are None.
     """
     assert real.shape == imag.shape, (real.shape, imag.shape)
-    rit = iter(dwi.util.sliding_window(real, winsize, mask=mask))
-    iit = iter(dwi.util.sliding_window(imag, winsize, mask=mask))
-    shape = (len(GABOR_FEAT_NAMES),) + real.shape
-    output = np.full(shape, np.nan, dtype=np.float32)
-    for ((y, x), rwin), (_, iwin) in zip(rit, iit):
-        output[:, y, x] = gabor_feats(rwin, iwin)
+    return (real,
+            np.square(real, dtype=np.float64) if 'var' in names else None,
+            np.abs(real) if 'absmean' in names else None,
+            np.hypot(real, imag) if 'mag' in names else None)
+
+
+def gabor_featmap(planes, winsize, mask, names=GABOR_FEAT_NAMES):
+    """Get Gabor feature map of shape (feats, height, width) from the planes
+    of a filtered image, see gabor_planes(). Parameter names may list the
+    features to calculate.
+
+    Window features are calculated for all windows at once by box filtering.
+    """
+    shape = planes[0].shape
+    winshape = dwi.util.normalize_sequence(winsize, len(shape))
+    output = np.full((len(names),) + shape, np.nan, dtype=np.float32)
+    real, square, absolute, mag = planes
+    feats = OrderedDict()
+    if 'mean' in names or 'var' in names:
+        feats['mean'] = dwi.util.window_means(real, winshape)
+    if 'var' in names:
+        sqmean = dwi.util.window_means(square, winshape)
+        feats['var'] = np.maximum(sqmean - feats['mean']**2, 0)
+    if 'absmean' in names:
+        feats['absmean'] = dwi.util.window_means(absolute, winshape)
+    if 'mag' in names:
+        feats['mag'] = dwi.util.window_means(mag, winshape)
+    origins = (slice(None),) + dwi.util.window_origins(shape, winshape)
+    output[origins] = [feats[x] for x in names]
+    if mask is not None:
+        output[:, ~mask] = np.nan
     return output
 
 
@@ -195,43 +548,198 @@ def get_sigma_y(frequency, bandwidth=None):
             (np.sqrt(2) * np.pi * frequency * np.tan(bandwidth / 2)))
 
 
-def gabor_map(img, winsize, mask=None, output=None):
-    """Gabor texture feature map. This is the (more) correct way."""
-    img = np.asarray(img, dtype=np.float32)
-    sigmas = dwi.rcParams.texture_gabor_sigmas
-    freqs = dwi.rcParams.texture_gabor_freqs
-    thetas = get_angles(dwi.rcParams.texture_gabor_orientations)
-    featnames = GABOR_FEAT_NAMES
-    tmaps = []
-    outnames = []
-    reals = np.empty((len(thetas),) + img.shape, dtype=np.float32)
-    imags = np.empty_like(reals)
+@lru_cache(maxsize=None)
+def gabor_bank(sigmas, freqs, n_orientations):
+    """Gabor filter bank for given configuration, cached.
+
+    Return complex kernels of shape (sigmas * freqs, orientations, height,
+    width). Kernels are zero-padded to a common shape, centered.
+    """
+    thetas = get_angles(n_orientations)
+    groups = []
     for sigma, freq in product(sigmas, freqs):
         if sigma is None:
             sigma_x = get_sigma_x(freq)
             sigma_y = get_sigma_y(freq)
         else:
             sigma_x = sigma_y = sigma
-        for t, theta in enumerate(thetas):
-            reals[t], imags[t] = skimage.filters.gabor(img, frequency=freq,
-                                                       theta=theta,
-                                                       # bandwidth=1)
-                                                       sigma_x=sigma_x,
-                                                       sigma_y=sigma_y)
-            reals[t][np.isnan(reals[t])] = 0
-            imags[t][np.isnan(imags[t])] = 0
-            assert np.all(np.isfinite(reals[t])), ('r', freq, theta)
-            assert np.all(np.isfinite(imags[t])), ('i', freq, theta)
-        # Sum orientations for invariance.
-        real = np.sum(reals, axis=0)
-        imag = np.sum(imags, axis=0)
-        featmaps = gabor_featmap(real, imag, winsize, mask)
-        for featmap, name in zip(featmaps, featnames):
-            tmaps.append(featmap)
+        groups.append([skimage.filters.gabor_kernel(freq, theta=theta,
+                                                    sigma_x=sigma_x,
+                                                    sigma_y=sigma_y)
+                       for theta in thetas])
+    ry = max(x.shape[0] for g in groups for x in g) // 2
+    rx = max(x.shape[1] for g in groups for x in g) // 2
+    shape = (len(groups), len(thetas), 2*ry+1, 2*rx+1)
+    bank = np.zeros(shape, dtype=np.complex128)
+    for kernels, group in zip(bank, groups):
+        for kernel, x in zip(kernels, group):
+            hy, hx = x.shape[0] // 2, x.shape[1] // 2
+            kernel[ry-hy:ry+hy+1, rx-hx:rx+hx+1] = x
+    bank.flags.writeable = False
+    return bank
+
+
+@lru_cache(maxsize=16)
+def gabor_bank_fft(sigmas, freqs, n_orientations, shape):
+    """Fourier transform of Gabor filter bank with orientations summed, for
+    given array shape, cached.
+
+    Summing the responses of linear filters is the same as filtering with the
+    summed kernel.
+    """
+    bank = gabor_bank(sigmas, freqs, n_orientations)
+    fbank = np.fft.fft2(bank.sum(axis=1), s=shape)
+    fbank.flags.writeable = False
+    return fbank
+
+
+@lru_cache(maxsize=4)
+def gabor_bank_oriented_fft(sigmas, freqs, n_orientations, shape):
+    """Fourier transform of each kernel in Gabor filter bank, for given array
+    shape, cached.
+    """
+    bank = gabor_bank(sigmas, freqs, n_orientations)
+    fbank = np.fft.fft2(bank, s=shape)
+    fbank.flags.writeable = False
+    return fbank
+
+
+@lru_cache(maxsize=None)
+def gabor_bank_footprints(sigmas, freqs, n_orientations):
+    """Footprints of the voxels that affect the real and imaginary response
+    of each kernel in Gabor filter bank, for spreading NaNs, cached.
+
+    Many kernels share a footprint, so return the distinct ones, and an array
+    of footprint indices of shape (sigmas * freqs, orientations, 2) for the
+    real and imaginary part of each kernel (-1 for none).
+    """
+    bank = gabor_bank(sigmas, freqs, n_orientations)
+    footprints = OrderedDict()
+    indices = np.full(bank.shape[:2] + (2,), -1, dtype=np.int64)
+    for index in np.ndindex(bank.shape[:2]):
+        # Spatial convolution skips zero weights. Negligible ones are
+        # rounding errors, exact zeros in a single precision kernel.
+        kernel = bank[index][::-1, ::-1]
+        eps = 1e-12 * np.abs(kernel).max()
+        for i, weights in enumerate((kernel.real, kernel.imag)):
+            footprint = np.abs(weights) > eps
+            if np.any(footprint):
+                key = footprint.tobytes()
+                footprints.setdefault(key, footprint)
+                indices[index + (i,)] = list(footprints).index(key)
+    footprints = np.array(list(footprints.values()))
+    footprints.flags.writeable = False
+    indices.flags.writeable = False
+    return footprints, indices
+
+
+def gabor_support():
+    """Return the radius of the configured Gabor filter bank kernels."""
+    bank = gabor_bank(tuple(dwi.rcParams.texture_gabor_sigmas),
+                      tuple(dwi.rcParams.texture_gabor_freqs),
+                      dwi.rcParams.texture_gabor_orientations)
+    return max(bank.shape[-2:]) // 2
+
+
+def gabor_filter(img, sigmas=None, freqs=None):
+    """Filter image with the whole configured Gabor filter bank, or the part
+    of it with given sigmas and frequencies.
+
+    Filtering is done in frequency domain, in one batch. Image border is
+    handled like in skimage.filters.gabor() by mirroring (mode 'reflect').
+    Return complex responses of shape (sigmas * freqs, height, width): real
+    and imaginary parts are the filter responses summed over orientations.
+    Responses that have a NaN voxel within kernel are set to zero separately
+    for each orientation, like gabor_map() used to do.
+    """
+    if sigmas is None:
+        sigmas = dwi.rcParams.texture_gabor_sigmas
+    if freqs is None:
+        freqs = dwi.rcParams.texture_gabor_freqs
+    sigmas, freqs = tuple(sigmas), tuple(freqs)
+    n_orientations = dwi.rcParams.texture_gabor_orientations
+    bank = gabor_bank(sigmas, freqs, n_orientations)
+    ry, rx = bank.shape[-2] // 2, bank.shape[-1] // 2
+    nans = np.isnan(img)
+    padded = np.pad(np.where(nans, 0, img), ((ry, ry), (rx, rx)),
+                    mode='symmetric')
+    fimg = np.fft.fft2(padded)
+    # Kernel origin is in corner, so the result is shifted by its radius.
+    crop = (Ellipsis, slice(2*ry, 2*ry+img.shape[0]),
+            slice(2*rx, 2*rx+img.shape[1]))
+    if not np.any(nans):
+        fbank = gabor_bank_fft(sigmas, freqs, n_orientations, padded.shape)
+        return np.fft.ifft2(fimg * fbank)[crop]
+    fbank = gabor_bank_oriented_fft(sigmas, freqs, n_orientations,
+                                    padded.shape)
+    footprints, indices = gabor_bank_footprints(sigmas, freqs, n_orientations)
+    # Each distinct footprint spreads the NaNs only once.
+    spread = [ndimage.maximum_filter(nans, footprint=x, mode='reflect') for x
+              in footprints]
+    responses = np.empty((len(bank),) + img.shape, dtype=np.complex128)
+    for response, fkernels, parts in zip(responses, fbank, indices):
+        oriented = np.fft.ifft2(fimg * fkernels)[crop]
+        for x, (i, j) in zip(oriented, parts):
+            if i >= 0:
+                x.real[spread[i]] = 0
+            if j >= 0:
+                x.imag[spread[j]] = 0
+        response[...] = oriented.sum(axis=0)
+    return responses
+
+
+def gabor_map(img, winsize, mask=None, output=None, features=None):
+    """Gabor texture feature map. This is the (more) correct way. See
+    gabor_maps().
+    """
+    return gabor_maps(img, [winsize], masks=[mask], features=features)[0]
+
+
+def gabor_maps(img, winsizes, masks=None, features=None):
+    """Gabor texture feature maps for several window sizes. Return a list of
+    (output, names) for each.
+
+    The whole filter bank is applied at once, see gabor_filter(). Filtering
+    and the planes for window features are shared by all window sizes.
+    Parameter features may list the features to calculate, then only the
+    needed filters and planes are used.
+    """
+    if masks is None:
+        masks = [None] * len(winsizes)
+    img = np.asarray(img, dtype=np.float64)
+    keys = [(sigma, freq, name) for sigma, freq in
+            product(dwi.rcParams.texture_gabor_sigmas,
+                    dwi.rcParams.texture_gabor_freqs)
+            for name in GABOR_FEAT_NAMES]
+    if features is not None:
+        keys = [k for k in keys if dwi.texture.feature_key(
+            translate_name('gabor{}'.format(k))) in features]
+        if not keys:
+            raise ValueError('No Gabor features selected: {}'.format(
+                features))
+    sigmas = list(OrderedDict.fromkeys(k[0] for k in keys))
+    freqs = list(OrderedDict.fromkeys(k[1] for k in keys))
+    planes = []
+    outnames = []
+    responses = gabor_filter(img, sigmas=sigmas, freqs=freqs)
+    for (sigma, freq), response in zip(product(sigmas, freqs), responses):
+        featnames = [k[2] for k in keys if k[:2] == (sigma, freq)]
+        if not featnames:
+            continue
+        real, imag = response.real, response.imag
+        assert np.all(np.isfinite(real)), ('r', freq)
+        assert np.all(np.isfinite(imag)), ('i', freq)
+        planes.append((gabor_planes(real, imag, featnames), featnames))
+        for name in featnames:
             s = translate_name('gabor{}'.format((sigma, freq, name)))
             outnames.append(s)
-    output = np.array(tmaps)
-    return output, outnames
+    del responses
+    results = []
+    for winsize, mask in zip(winsizes, masks):
+        output = np.concatenate([gabor_featmap(x, winsize, mask, names=n) for
+                                 x, n in planes])
+        results.append((output, list(outnames)))
+    return results
 
 
 # Histogram of Oriented Gradients (HOG)
@@ -253,16 +761,72 @@ def hog(img):
     return np.mean(feats)
 
 
+def hog_bins(orientation, n):
+    """Orientation bin indices of gradients like in skimage.feature.hog(),
+    which uses single precision bin limits.
+    """
+    limits = np.float32(180 / n) * np.arange(n + 1, dtype=np.float32)
+    return np.digitize(orientation, limits) - 1
+
+
+def hog_normalize(hist, eps=1e-5):
+    """Normalize orientation histograms of shape (orientations, ...) like
+    skimage.feature.hog() with one cell per block (the default L2-Hys).
+    """
+    out = hist / np.sqrt(np.sum(hist**2, axis=0) + eps**2)
+    out = np.minimum(out, 0.2)
+    out /= np.sqrt(np.sum(out**2, axis=0) + eps**2)
+    return out
+
+
 def hog_map(img, winsize, mask=None, output=None):
-    """Histogram of oriented gradients (HOG) texture feature map."""
-    for pos, win in dwi.util.sliding_window(img, winsize, mask=mask):
-        feats = [hog(win)]
-        if output is None:
-            dtype = dwi.rcParams.texture_dtype
-            output = np.zeros((len(feats),) + img.shape, dtype=dtype)
-        for i, v in enumerate(feats):
-            output[(i,) + pos] = v
+    """Histogram of oriented gradients (HOG) texture feature map.
+
+    Gradients are calculated once for the whole image, and orientation
+    histograms for all windows at once by box filtering the magnitudes of
+    each orientation. Like in hog(), each window is a single cell whose
+    gradient is zero at its border across the border.
+    """
+    img = np.asarray(img)
+    if img.dtype not in (np.float32, np.float64):
+        img = img.astype(np.float64)
+    winshape = tuple(dwi.util.normalize_sequence(winsize, img.ndim))
+    n = dwi.rcParams.texture_hog_orientations
+    if output is None:
+        dtype = dwi.rcParams.texture_dtype
+        output = np.zeros((1,) + img.shape, dtype=dtype)
     names = ['hog']
+    if min(winshape) < 3:
+        # No inner pixels, do it the slow way.
+        for pos, win in dwi.util.sliding_window(img, winsize, mask=mask):
+            output[(0,) + pos] = hog(win)
+        return output, names
+    h, w = winshape
+    g_row = np.zeros_like(img)
+    g_col = np.zeros_like(img)
+    g_row[1:-1, :] = img[2:, :] - img[:-2, :]
+    g_col[:, 1:-1] = img[:, 2:] - img[:, :-2]
+    g_row = g_row.astype(np.float64)
+    g_col = g_col.astype(np.float64)
+    magnitude = np.hypot(g_col, g_row)
+    orientation = np.rad2deg(np.arctan2(g_row, g_col)) % 180
+    bins = hog_bins(orientation, n)
+    planes = magnitude * (bins == np.arange(n).reshape((n, 1, 1)))
+    # Inner pixels, top and bottom border, left and right border.
+    inner = dwi.util.window_means(planes, (1, h-2, w-2)) * (h-2) * (w-2)
+    hist = inner[:, 1:-1, 1:-1]
+    rows = dwi.util.window_means(np.abs(g_col), (1, w-2)) * (w-2)
+    cols = dwi.util.window_means(np.abs(g_row), (h-2, 1)) * (h-2)
+    hist[0] += rows[:1-h or None, 1:-1] + rows[h-1:, 1:-1]
+    hist[hog_bins(90, n)] += cols[1:-1, :1-w or None] + cols[1:-1, w-1:]
+    hist /= h * w
+    feats = np.mean(hog_normalize(hist), axis=0)
+    origins = dwi.util.window_origins(img.shape, winshape)
+    if mask is None:
+        output[(0,) + origins] = feats
+    else:
+        selected = mask[origins]
+        output[0][origins][selected] = feats[selected]
     return output, names
 
 
@@ -283,23 +847,82 @@ def hu(img, postproc=True):
     m = skimage.measure.moments_normalized(m)
     m = skimage.measure.moments_hu(m)
     if postproc:
-        m = abs(m)  # Last one changes sign on reflection.
-        m[m == 0] = 1  # Required by log.
-        m = np.log(m)  # They are small, usually logarithms are used.
+        m = hu_postproc(m)
     m = np.nan_to_num(m)  # Not sure why there are sometimes NaN values.
     assert m.shape == (7,)
     return m
 
 
+def hu_postproc(m):
+    """Take logarithms of absolute values of Hu moments."""
+    m = abs(m)  # Last one changes sign on reflection.
+    m[m == 0] = 1  # Required by log.
+    m = np.log(m)  # They are small, usually logarithms are used.
+    return m
+
+
+@lru_cache(maxsize=None)
+def hu_kernels(winshape):
+    """Kernels for central moments up to order 3 about window center, like in
+    hu(), cached. Return array of shape (4, 4) + winshape.
+    """
+    r, c = np.indices(winshape, dtype=np.double)
+    r -= winshape[0] / 2
+    c -= winshape[1] / 2
+    powers = np.arange(4).reshape((4, 1, 1))
+    kernels = r**powers[:, np.newaxis] * c**powers
+    kernels.flags.writeable = False
+    return kernels
+
+
+def hu_invariants(mu):
+    """The seven moments of Hu from central moments of shape (4, 4, ...).
+
+    Moments are normalized and combined like in skimage.measure, for all
+    trailing positions at once. Return array of shape (7, ...).
+    """
+    p, q = np.indices((4, 4))
+    exponents = ((p + q) / 2 + 1).reshape((4, 4) + (1,) * (mu.ndim - 2))
+    nu = mu / mu[0, 0]**exponents
+    t0 = nu[3, 0] + nu[1, 2]
+    t1 = nu[2, 1] + nu[0, 3]
+    q0 = t0 * t0
+    q1 = t1 * t1
+    n4 = 4 * nu[1, 1]
+    s = nu[2, 0] + nu[0, 2]
+    d = nu[2, 0] - nu[0, 2]
+    hu = np.empty((7,) + mu.shape[2:], dtype=nu.dtype)
+    hu[0] = s
+    hu[1] = d * d + n4 * nu[1, 1]
+    hu[3] = q0 + q1
+    hu[5] = d * (q0 - q1) + n4 * t0 * t1
+    t0 *= q0 - 3 * q1
+    t1 *= 3 * q0 - q1
+    q0 = nu[3, 0] - 3 * nu[1, 2]
+    q1 = 3 * nu[2, 1] - nu[0, 3]
+    hu[2] = q0 * q0 + q1 * q1
+    hu[4] = q0 * t0 + q1 * t1
+    hu[6] = q1 * t0 - q0 * t1
+    return hu
+
+
 def hu_map(img, winsize, mask=None, output=None):
-    """Hu moment map."""
-    for pos, win in dwi.util.sliding_window(img, winsize, mask=mask):
-        feats = hu(win)
-        if output is None:
-            dtype = dwi.rcParams.texture_dtype
-            output = np.zeros((len(feats),) + img.shape, dtype=dtype)
-        for i, v in enumerate(feats):
-            output[(i,) + pos] = v
+    """Hu moment map.
+
+    Central moments of all windows are calculated in one go with precalculated
+    moment kernels, see hu_kernels().
+    """
+    img = np.asarray(img, dtype=np.double)
+    winshape = tuple(dwi.util.normalize_sequence(winsize, img.ndim))
+    kernels = hu_kernels(winshape).reshape((-1,) + winshape)
+    origins, mu = dwi.util.window_dot(img, kernels, mask=mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        feats = hu_postproc(hu_invariants(mu.reshape((4, 4, -1))))
+    feats = np.nan_to_num(feats)
+    if output is None:
+        dtype = dwi.rcParams.texture_dtype
+        output = np.zeros((len(feats),) + img.shape, dtype=dtype)
+    output[(slice(None),) + origins] = feats
     # TODO: Shift indices in feature names to be one-based.
     names = ['hu({})'.format(i) for i in range(len(feats))]
     return output, names
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+"""Benchmark texture methods over window sizes on synthetic images.
+
+Slices of DWI and T2w size are generated with masks of several sizes, and each
+texture method is run with the configured window sizes (rcParams). Window
+count, features, time, windows per second, and peak memory are reported for
+each run. The results are written as JSON, for comparing runs across commits.
+Nothing is read from disk.
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import ndimage
+
+import dwi
+import dwi.texture
+
+# Synthetic slice shape, value range, data type, and imaging mode for
+# normalization.
+IMAGES = OrderedDict([
+    ('DWI', ((160, 160), (0, 0.003), np.float32, 'DWI-Mono-ADCm')),
+    ('T2w', ((512, 512), (0, 2000), np.int16, 'T2w')),
+])
+
+
+def parse_args():
+    """Parse command-line arguments."""
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument('--verbose', '-v', action='count',
+                   help='increase verbosity')
+    p.add_argument('--images', nargs='+', choices=IMAGES.keys(),
+                   default=list(IMAGES.keys()),
+                   help='synthetic image types')
+    p.add_argument('--masks', metavar='RADIUS', type=float, nargs='+',
+                   default=[0.05, 0.1, 0.2],
+                   help='mask disc radii, as portion of slice side')
+    p.add_argument('--methods', metavar='METHOD', nargs='+',
+                   default=list(dwi.texture.METHODS.keys()),
+                   help='texture methods')
+    p.add_argument('--winsizes', metavar='WINSIZE', type=int, nargs='+',
+                   help='window sizes instead of configured ones')
+    p.add_argument('--repeat', type=int, default=1,
+                   help='number of timed runs, the fastest is reported')
+    p.add_argument('--seed', type=int, default=0,
+                   help='random seed for synthetic images')
+    p.add_argument('--output', metavar='FILENAME',
+                   help='output JSON file (default: standard output)')
+    return p.parse_args()
+
+
+def synthetic_image(shape, value_range, dtype, seed=0):
+    """Generate a single-slice image of smooth noise with some texture."""
+    rng = np.random.RandomState(seed)
+    img = sum(ndimage.gaussian_filter(rng.rand(*shape), sigma) for sigma in
+              (1, 3, 9))
+    img -= img.min()
+    img /= img.max()
+    lo, hi = value_range
+    img = lo + img * (hi - lo)
+    return img.astype(dtype)[np.newaxis]
+
+
+def disc_mask(shape, radius):
+    """Generate a single-slice mask with a centered disc."""
+    y, x = np.indices(shape) - (np.array(shape) // 2)[:, np.newaxis,
+                                                        np.newaxis]
+    return (np.hypot(y, x) <= radius)[np.newaxis]
+
+
+def winspecs(method, image, winsizes=None):
+    """Return window specifications of a method for an image type, like in
+    the texture pipeline.
+    """
+    if method == 'raw':
+        return ['1']
+    elif method.endswith('_all'):
+        return ['all']
+    elif method.endswith('_mbb'):
+        return ['mbb']
+    elif method == 'sobel':
+        return ['3']
+    if winsizes is None:
+        if image == 'T2w':
+            winsizes = dwi.rcParams.texture_winsizes_large
+        else:
+            winsizes = dwi.rcParams.texture_winsizes_small
+    return [str(x) for x in winsizes]
+
+
+def run(img, mask, mode, method, winspec):
+    """Calculate a texture map. Return the texture map and feature names."""
+    session = dwi.texture.TextureSession(img, mask, mode)
+    return session.texture(dwi.TextureSpec(method, winspec, None), avg='mean')
+
+
+def benchmark(img, mask, mode, method, winspec, repeat=1):
+    """Benchmark a texture method. Return a dictionary of results.
+
+    Time is measured without tracing memory, which is done in a separate run.
+    """
+    d = OrderedDict()
+    session = dwi.texture.TextureSession(img, mask, mode)
+    d['windows'] = int(session.n_windows(dwi.TextureSpec(method, winspec,
+                                                         None)))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        _, names = run(img, mask, mode, method, winspec)
+        times.append(time.perf_counter() - start)
+    d['features'] = len(names)
+    d['time'] = min(times)
+    d['windows_per_s'] = d['windows'] / d['time']
+    tracemalloc.start()
+    try:
+        run(img, mask, mode, method, winspec)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    d['peak_mb'] = peak / 2**20
+    return d
+
+
+def git_revision():
+    """Return the git revision of the source tree, if available."""
+    try:
+        s = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                    cwd=os.path.dirname(dwi.__file__),
+                                    stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return s.decode().strip()
+
+
+def info():
+    """Return information on the environment."""
+    d = OrderedDict()
+    d['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    d['revision'] = git_revision()
+    d['python'] = platform.python_version()
+    d['numpy'] = np.__version__
+    d['platform'] = platform.platform()
+    d['cpus'] = os.cpu_count()
+    d['tilejobs'] = dwi.rcParams.tilejobs
+    d['tilesize'] = dwi.rcParams.tilesize
+    d['argv'] = sys.argv[1:]
+    return d
+
+
+def main():
+    args = parse_args()
+    loglevel = logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig(level=loglevel, stream=logging.sys.stderr)
+
+    results = []
+    for image in args.images:
+        shape, value_range, dtype, mode = IMAGES[image]
+        img = synthetic_image(shape, value_range, dtype, seed=args.seed)
+        for radius in args.masks:
+            mask = disc_mask(shape, radius * min(shape))
+            for method in args.methods:
+                for winspec in winspecs(method, image, args.winsizes):
+                    d = OrderedDict()
+                    d['image'] = image
+                    d['shape'] = shape
+                    d['mask_radius'] = radius
+                    d['voxels'] = int(np.count_nonzero(mask))
+                    d['method'] = method
+                    d['winspec'] = winspec
+                    try:
+                        d.update(benchmark(img, mask, mode, method, winspec,
+                                           repeat=args.repeat))
+                    except Exception as e:
+                        logging.warning('Failed: %s, %s', list(d.values()),
+                                        e)
+                        d['error'] = '{}: {}'.format(type(e).__name__, e)
+                    else:
+                        logging.info('%s %s %s-%s: %.3f s, %.0f windows/s, '
+                                     '%.1f MB', image, radius, method,
+                                     winspec, d['time'], d['windows_per_s'],
+                                     d['peak_mb'])
+                    results.append(d)
+
+    s = json.dumps(OrderedDict([('info', info()), ('results', results)]),
+                   indent=2)
+    if args.output is None:
+        print(s)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(s + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -91,14 +91,8 @@ def main():
 
     model = [x for x in dwi.models.Models if x.name == args.model][0]
 
-    image, attrs = dwi.files.read_pmap(args.input, params=args.params)
-    assert image.ndim == 4, image.ndim
-    if args.verbose:
-        print('Read image', image.shape, image.dtype, args.input)
-        print('Parameters', attrs['parameters'])
+    mask, mbb = None, None
     if args.mask:
-        if args.verbose:
-            print('Applying mask', args.mask)
         mask = dwi.mask.read_mask(args.mask)
         if args.mbb:
             mbb = mask.bounding_box(args.mbb)
@@ -106,7 +100,23 @@ def main():
                 print('Using minimum bounding box {m}'.format(m=mbb))
             z, y, x = [slice(*t) for t in mbb]
             mask.array[z, y, x] = True
-            attrs['mbb'] = args.mbb
+
+    # Read only the bounding box, if any; the rest would be masked anyway.
+    image, attrs = dwi.files.read_pmap(args.input, params=args.params,
+                                       region=mbb)
+    if mbb is not None:
+        full = np.full(mask.shape() + image.shape[-1:], np.nan,
+                       dtype=image.dtype)
+        full[dwi.files.region_slices(mbb)] = image
+        image = full
+        attrs['mbb'] = args.mbb
+    assert image.ndim == 4, image.ndim
+    if args.verbose:
+        print('Read image', image.shape, image.dtype, args.input)
+        print('Parameters', attrs['parameters'])
+    if mask is not None:
+        if args.verbose:
+            print('Applying mask', args.mask)
         image = mask.apply_mask(image, value=np.nan)
         attrs['mask'] = args.mask
     if args.subwindow:
@@ -1,18 +1,26 @@
 #!/usr/bin/python3
 
-"""Calculate texture properties for a masked area."""
+"""Calculate texture properties for a masked area.
+
+Several texture methods may be given at once, in which case the image and mask
+are read and prepared only once, and the results are written into one file.
+
+Likewise, several parameters of the image may be given. Their features are
+calculated in one pass, and feature names are prefixed with parameter names.
+"""
 
 import argparse
-from collections import defaultdict
 import logging
 
 import numpy as np
 
 import dwi.files
+import dwi.hdf5
 import dwi.mask
 import dwi.standardize
 import dwi.texture
 import dwi.util
+from dwi.types import TextureSpec
 
 
 def parse_args():
@@ -24,51 +32,37 @@ def parse_args():
                    help='input image')
     p.add_argument('--mask',
                    help='mask file to use')
-    p.add_argument('--mode', metavar='MODE', required=True,
-                   help='imaging mode specification')
-    p.add_argument('--method', metavar='METHOD', required=True,
+    p.add_argument('--mode', metavar='MODE', nargs='+', required=True,
+                   help='imaging mode specification, or one for each '
+                   'parameter')
+    p.add_argument('--params', metavar='PARAM', nargs='+', default=['0'],
+                   help='image parameters to use (names or indices)')
+    p.add_argument('--method', metavar='METHOD',
                    help='method')
     p.add_argument('--slices', default='maxfirst',
                    help='slice selection (maxfirst, max, all)')
     p.add_argument('--winspec', default='5',
                    help='window specification (side length, all, mbb)')
+    p.add_argument('--tspec', metavar='TSPEC', nargs='+', default=[],
+                   help='texture specifications (like glcm-5, or with '
+                   'a feature like glcm-5-contrast,2,mean), instead of '
+                   'method and window specification')
     p.add_argument('--portion', type=float, default=0,
                    help='portion of selected voxels required for each window')
-    p.add_argument('--voxel', choices=('all', 'mean', 'median'), default='all',
-                   help='voxel to output (all, mean, median)')
-    p.add_argument('--output', metavar='FILENAME', required=True,
-                   help='output texture map file')
+    p.add_argument('--voxel', choices=('all', 'mean', 'median'), nargs='+',
+                   default=['all'],
+                   help='voxel to output (all, mean, median), one or more')
+    p.add_argument('--output', metavar='FILENAME', nargs='+', required=True,
+                   help='output texture map file for each voxel output')
     return p.parse_args()
 
 
-def max_mask(mask, winsize):
-    """Return a mask that has the voxels selected that have the maximum number
-    of surrounding voxels selected in the original mask.
-    """
-    d = defaultdict(list)
-    for pos, win in dwi.util.sliding_window(mask, winsize, mask=mask):
-        d[np.count_nonzero(win)].append(pos)
-    r = np.zeros_like(mask)
-    for pos in d[max(d)]:
-        r[pos] = True
-    return r
-
-
-def portion_mask(mask, winsize, portion=1, resort_to_max=True):
-    """Return a mask that selects (only) voxels that have the window at each
-    selected voxel origin up to a minimum portion in the original mask selected
-    (1 means the whole window must be selected, 0 gives the original mask).
-
-    If resort_to_max is true, the window with maximum number of selected voxels
-    is used in case the resulting mask would otherwise be empty.
+def parse_tspec(s):
+    """Parse texture specification like 'glcm-5' (method and window), or
+    'glcm-5-contrast,2,mean' (with feature).
     """
-    r = np.zeros_like(mask)
-    for pos, win in dwi.util.sliding_window(mask, winsize, mask=mask):
-        if np.count_nonzero(win) / win.size >= portion:
-            r[pos] = True
-    if resort_to_max and np.count_nonzero(r) == 0:
-        r = max_mask(mask, winsize)
-    return r
+    method, winspec, *feature = s.split('-', 2)
+    return TextureSpec(method, winspec, feature[0] if feature else None)
 
 
 def main():
@@ -76,16 +70,31 @@ def main():
     loglevel = logging.INFO if args.verbose else logging.WARNING
     logging.basicConfig(level=loglevel, stream=logging.sys.stdout)
 
+    if args.tspec:
+        tspecs = [parse_tspec(x) for x in args.tspec]
+    elif args.method:
+        tspecs = [TextureSpec(args.method, args.winspec, None)]
+    else:
+        raise ValueError('No texture method given.')
+    if len(args.output) != len(args.voxel):
+        raise ValueError('Need an output file for each voxel output.')
+    if len(args.mode) not in (1, len(args.params)):
+        raise ValueError('Need one mode, or one for each parameter.')
+
     logging.info('Reading image: %s', args.input)
-    img, attrs = dwi.files.read_pmap(args.input)
-    if args.mode == 'T2':
+    img, attrs = dwi.files.read_pmap(args.input, params=args.params)
+    if 'T2' in args.mode:
         assert attrs['echotimes'][0] == 0  # TODO: Could be another?
-    img = img[..., 0]
-    assert img.ndim == 3
+    params = attrs['parameters']
+    mode = args.mode[0] if len(args.mode) == 1 else args.mode
+    if img.shape[-1] == 1:
+        img = img[..., 0]  # Single parameter, names are not prefixed.
+        params = None
+    assert img.ndim in (3, 4)
 
     if args.mask is None:
-        mask = np.zeros_like(img, dtype=np.bool)
-        mbb = dwi.util.bbox(img, pad=0)
+        mask = np.zeros(img.shape[:3], dtype=np.bool)
+        mbb = dwi.util.bbox(img, pad=0)[:3]
         logging.info('MBB mask: %s', mbb)
         mask[mbb] = True
         mask = dwi.mask.Mask3D(mask)
@@ -95,7 +104,7 @@ def main():
         if isinstance(mask, dwi.mask.Mask):
             mask = mask.convert_to_3d(img.shape[0])
 
-    if img.shape != mask.shape():
+    if img.shape[:3] != mask.shape():
         raise Exception('Image shape {} does not match mask shape {}'.format(
             img.shape, mask.shape()))
     if mask.n_selected() == 0:
@@ -116,50 +125,36 @@ def main():
             mask.array[i, :, :] = 0
 
     # Use only selected slices to save memory.
-    if not args.voxel == 'all':
+    if 'all' not in args.voxel:
         img = img[slice_indices].copy()
         mask.array = mask.array[slice_indices].copy()
 
-    # Get portion mask.
-    if args.winspec in ('all', 'mbb'):
-        pmask = mask.array  # Some methods don't use window.
-    elif args.winspec.isdigit():
-        winsize = int(args.winspec)
-        assert winsize > 0
-        winshape = (1, winsize, winsize)
-        pmask = portion_mask(mask.array, winshape, portion=args.portion)
-    else:
-        raise ValueError('Invalid window spec: {}'.format(args.winspec))
+    logging.info('Image: %s, slice: %s, voxels: %s, textures: %s', img.shape,
+                 slice_indices, np.count_nonzero(mask.array),
+                 ' '.join(str(x) for x in tspecs))
 
-    logging.info('Image: %s, slice: %s, voxels: %s, window: %s', img.shape,
-                 slice_indices, np.count_nonzero(mask.array), args.winspec)
-
-    logging.info('Calculating %s texture features for %s...', args.method,
-                 args.mode)
-
-    dwi.rcParams.texture_avg = args.voxel
-    if dwi.rcParams.texture_avg != 'all':
-        if args.mode.startswith('T2w') and args.method.startswith('gabor'):
-            # These result arrays can get quite huge (if float64).
-            dwi.rcParams.texture_path = args.output
-
-    if args.method in ('glcm', 'glcm_mbb'):
-        img = dwi.util.quantize(dwi.util.normalize(img, args.mode))
-
-    tmap, names = dwi.texture.get_texture(img, args.method, args.winspec,
-                                          pmask)
+    session = dwi.texture.TextureSession(img, mask.array, mode,
+                                         portion=args.portion, params=params)
+    tmaps, names = session.textures(tspecs, avg=args.voxel)
     attrs['parameters'] = names
-    # Number of windows, or resulting texture map volume in general.
-    attrs['tmap_voxels'] = np.count_nonzero(pmask)
-
-    logging.info('Writing shape %s, type %s to %s', tmap.shape, tmap.dtype,
-                 args.output)
-    if dwi.rcParams.texture_path:
-        attrs['shape'] = tmap.shape
-        attrs['dtype'] = str(tmap.dtype)
-        dwi.hdf5.write_attrs(tmap, attrs)  # Attributes may need conversion.
-    else:
-        dwi.files.write_pmap(args.output, tmap, attrs)
+    # Number of windows, or resulting texture map volume in general, for each
+    # texture specification.
+    attrs['tmap_voxels'] = [session.n_windows(x) for x in tspecs]
+    if dwi.rcParams.texture_approx_winsize:
+        # Downsampling factor for each texture specification, and maximum
+        # absolute error for each approximated feature (NaN if exact).
+        attrs['approx_factor'] = [session.approx_factor(x.method, x.winsize)
+                                  for x in tspecs]
+        attrs['approx_error'] = [session.approx_errors.get(x, np.nan)
+                                 for x in names]
+
+    for voxel, outfile in zip(args.voxel, args.output):
+        tmap = tmaps[voxel]
+        logging.info('Writing shape %s, type %s to %s', tmap.shape,
+                     tmap.dtype, outfile)
+        dwi.files.write_pmap(outfile, tmap, dict(attrs))
+        if isinstance(tmap, dwi.hdf5.h5py.Dataset):
+            tmap.file.close()  # On disk, see rcParams.texture_path.
 
 
 if __name__ == '__main__':
@@ -228,11 +228,8 @@ def main():
     args = parse_args()
     set_loggin(verbosity=args.verbose)
 
+    # With HDF5, only the needed part of image is read later on.
     image, attrs = dwi.files.read_pmap(args.image, ondisk=True)
-    if args.param is not None:
-        image = image[..., args.param]
-        image.shape += (1,)
-        attrs['parameters'] = [attrs['parameters'][args.param]]
     spacing = attrs['voxel_spacing']
 
     # Read masks.
@@ -253,12 +250,14 @@ def main():
 
     lesiontype = get_lesiontype_array(args.lesiontypes, lesions)
 
-    # Crop MBB. The remaining image is stored in memory.
+    # Crop MBB. The remaining image is read into memory.
     if args.mbb is None:
         slices = tuple(slice(0, x) for x in image.shape[:3])
     else:
         slices = get_mbb(prostate, spacing, args.mbb)
-    image = image[slices]
+    image, attrs = dwi.files.select_pmap(
+        image, attrs, region=slices,
+        params=None if args.param is None else [args.param])
     prostate = prostate[slices]
     lesion = lesion[slices]
     lesiontype = lesiontype[slices]
@@ -215,7 +215,7 @@ def scale(img):
     if not np.issubdtype(img.dtype, float):
         img = img.astype(np.float_)  # Integers cannot be scaled.
     for i in range(img.shape[-1]):
-        img[..., i] = dwi.util.scale(img[..., i])
+        dwi.util.scale(img[..., i], out=img[..., i])
     print('Scaled to range: [{}, {}]'.format(img.min(), img.max()))
     return img
 
@@ -279,7 +279,8 @@ def main():
             for si in img.reshape((-1, img.shape[-1])):
                 dwi.util.normalize_si_curve_fix(si)
         else:
-            img = dwi.util.normalize(img, args.normalize).astype(np.float32)
+            out = img if img.dtype == np.float32 else None
+            img = dwi.util.normalize(img, args.normalize, out=out)
 
     if args.scale:
         img = scale(img)
@@ -6,14 +6,13 @@ import os
 import platform
 from collections import OrderedDict
 from functools import reduce
+from itertools import product
 
 import numpy as np
 
-from scipy import spatial
+from scipy import ndimage, spatial
 from scipy.ndimage import interpolation
 
-from skimage import exposure
-
 
 def one(iterable, too_short=None, too_long=None):
     """Return the first item from *iterable*, which is expected to contain only
@@ -129,6 +128,160 @@ def sliding_window(a, winshape, mask=None):
             yield origin, window
 
 
+def sum_dtype(dtype):
+    """Return a data type for accumulating sums of another without wrapping
+    around: int64 for booleans and integers, float64 or complex128 for others.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.complexfloating):
+        return np.dtype(np.complex128)
+    if np.issubdtype(dtype, np.inexact):
+        return np.dtype(np.float64)
+    return np.dtype(np.int64)
+
+
+def integral_image(a, dtype=None):
+    """Return the summed-area table of an array, padded with zeros in front of
+    each axis. Sum of any box a[i0:i1, j0:j1, ...] is then given by the
+    inclusion-exclusion of its corners in the table.
+
+    The table data type is by default wide enough not to overflow, see
+    sum_dtype().
+    """
+    a = np.asanyarray(a)
+    if dtype is None:
+        dtype = sum_dtype(a.dtype)
+    sat = np.zeros(tuple(x + 1 for x in a.shape), dtype=dtype)
+    sat[(slice(1, None),) * a.ndim] = a
+    for axis in range(a.ndim):
+        np.cumsum(sat, axis=axis, out=sat)
+    return sat
+
+
+def window_sums(a, winshape, sat=None, dtype=None):
+    """Sum each window that fits inside an array, by using an integral image.
+
+    Result is indexed by window position like in sliding_window(), i.e. its
+    shape is `a.shape - winshape + 1`, see window_origins() for placing it.
+    A precalculated integral image may be passed as `sat`. Otherwise sums are
+    accumulated in dtype, by default int64 for integer input and float64 for
+    floating point, see sum_dtype().
+    """
+    if sat is None:
+        sat = integral_image(a, dtype=dtype)
+    ndim = sat.ndim
+    winshape = normalize_sequence(winshape, ndim)
+    shape = tuple(n - w for n, w in zip(sat.shape, winshape))
+    if not all(x > 0 for x in shape):
+        raise ValueError('Invalid window shape: {}'.format(winshape))
+    sums = np.zeros(shape, dtype=sat.dtype)
+    for corner in product((0, 1), repeat=ndim):
+        slices = tuple(slice(w * c, w * c + n) for c, w, n in
+                       zip(corner, winshape, shape))
+        if (ndim - sum(corner)) % 2:
+            sums -= sat[slices]
+        else:
+            sums += sat[slices]
+    return sums
+
+
+def window_means(a, winshape):
+    """Mean of each window that fits inside an array, by box filtering.
+
+    Result is indexed by window position like in window_sums(). Box filter
+    sums run along each axis in double precision, which keeps them accurate
+    for floating point data, too.
+
+    Windows that contain NaN get NaN. Because a NaN would spread along the
+    running sums to later windows, too, NaNs are filtered as zero, and
+    counted separately.
+    """
+    a = np.asanyarray(a, dtype=np.float64)
+    winshape = normalize_sequence(winshape, a.ndim)
+    if not all(0 < w <= i for w, i in zip(winshape, a.shape)):
+        raise ValueError('Invalid window shape: {}'.format(winshape))
+    nans = np.isnan(a)
+    has_nans = nans.any()
+    if has_nans:
+        a = np.where(nans, 0, a)
+    means = ndimage.uniform_filter(a, size=winshape, mode='constant')
+    means = means[window_origins(a.shape, winshape)]
+    if has_nans:
+        means[window_sums(nans, winshape) > 0] = np.nan
+    return means
+
+
+def window_view(a, winshape):
+    """Return a read-only strided view of all windows that fit inside an
+    array, shaped as `positions + winshape`. Windows are like in
+    sliding_window(), see window_origins() for placing results indexed by
+    position. Nothing is copied.
+    """
+    a = np.asanyarray(a)
+    winshape = tuple(normalize_sequence(winshape, a.ndim))
+    if not all(0 < w <= i for w, i in zip(winshape, a.shape)):
+        raise ValueError('Invalid window shape: {}'.format(winshape))
+    shape = tuple(i - w + 1 for i, w in zip(a.shape, winshape))
+    return np.lib.stride_tricks.as_strided(a, shape + winshape,
+                                           a.strides * 2, writeable=False)
+
+
+def window_batches(a, winshape, mask=None, batchsize=4096):
+    """Multidimensional sliding window in batches, a vectorized companion of
+    sliding_window() with the same windows and mask semantics.
+
+    Yields window origins (a tuple of index arrays) and the windows, shaped as
+    `(n,) + winshape`, for at most `batchsize` windows at a time. The windows
+    of a batch are copied from the array to bound memory use.
+    """
+    a = np.asanyarray(a)
+    view = window_view(a, winshape)
+    winshape = view.shape[a.ndim:]
+    if mask is None:
+        positions = tuple(np.indices(view.shape[:a.ndim]).reshape(a.ndim, -1))
+    else:
+        mask = np.asanyarray(mask)
+        positions = np.nonzero(mask[window_origins(a.shape, winshape)])
+    for i in range(0, len(positions[0]), batchsize):
+        batch = tuple(p[i:i+batchsize] for p in positions)
+        origins = tuple(p + w // 2 for p, w in zip(batch, winshape))
+        yield origins, view[batch]
+
+
+def window_dot(a, kernels, mask=None, chunksize=4096):
+    """Dot product of each window with each kernel.
+
+    Windows are chosen like in sliding_window(), their shape is given by the
+    kernels, which have shape `(n,) + winshape`. Return window origins (as a
+    tuple of index arrays) and the products of shape `(n, windows)`. Windows
+    are copied and multiplied in chunks of `chunksize` to bound memory use,
+    see window_batches().
+    """
+    a = np.asanyarray(a)
+    kernels = np.asanyarray(kernels)
+    winshape = kernels.shape[1:]
+    if len(winshape) != a.ndim:
+        raise ValueError('Invalid window shape: {}'.format(winshape))
+    kernels = kernels.reshape(len(kernels), -1)
+    origins = [(np.zeros(0, dtype=np.intp),) * a.ndim]
+    products = [np.zeros((len(kernels), 0), dtype=np.result_type(a, kernels))]
+    for batch, windows in window_batches(a, winshape, mask=mask,
+                                         batchsize=chunksize):
+        origins.append(batch)
+        products.append(kernels.dot(windows.reshape(len(windows), -1).T))
+    origins = tuple(np.concatenate(x) for x in zip(*origins))
+    return origins, np.concatenate(products, axis=1)
+
+
+def window_origins(shape, winshape):
+    """Return the slices that place an array indexed by window position (like
+    the result of window_sums()) at window origins in an array of `shape`.
+    """
+    winshape = normalize_sequence(winshape, len(shape))
+    return tuple(slice(w // 2, w // 2 + n - w + 1) for n, w in
+                 zip(shape, winshape))
+
+
 def bounding_box(array, pad=0):
     """Return the minimum bounding box with optional padding.
 
@@ -210,14 +363,22 @@ def normalize_si_curve_fix(si):
         si[:] /= si[0]
 
 
-def scale(a):
+def scale(a, out=None):
     """Apply feature scaling: bring all values to range [0, 1], while ignoring
     NaN values.
+
+    The result is written slice by slice into `out` (by default a new float
+    array), which may be the input itself if it is float.
     """
-    # TODO: Allow in-place, this is a likely memory hog.
     a = np.asanyarray(a)
     mn, mx = np.nanmin(a), np.nanmax(a)
-    return (a - mn) / (mx - mn)
+    if out is None:
+        floating = np.issubdtype(a.dtype, np.floating)
+        out = np.empty(a.shape, dtype=a.dtype if floating else np.float64)
+    for x, o in zip(_slices(a), _slices(out)):
+        np.subtract(x, mn, out=o)
+        o /= mx - mn
+    return out
 
 
 def flip_minmax(a):
@@ -303,8 +464,8 @@ def dump_json(obj, separators=(', ', ': '), sort_keys=False):
     return json.dumps(obj, separators=separators, sort_keys=sort_keys)
 
 
-def normalize(pmap, mode):
-    """Normalize images within mode-specific range."""
+def normalize_range(pmap, mode):
+    """Return the mode-specific input value range for normalize()."""
     shortcuts = dict(ADCm='DWI-Mono-ADCm', ADCk='DWI-Kurt-ADCk',
                      K='DWI-Kurt-K')
     mode = shortcuts.get(str(mode), mode)
@@ -331,28 +492,94 @@ def normalize(pmap, mode):
     elif mode == 'T2w-std':
         in_range = (1, 4095)
     elif mode == 'T2w':
-        if pmap.dtype == np.int32:
-            # The rescaler cannot handle int32.
-            pmap = np.asarray(pmap, dtype=np.int16)
         # assert pmap.dtype == np.int16
         in_range = (0, 2000)
     else:
         raise ValueError('Invalid mode: {}'.format(mode))
     logging.debug('Normalizing: %s, %s', mode, in_range)
-    pmap = pmap.astype(np.float32, copy=False)
-    pmap = np.nan_to_num(pmap)
-    pmap = exposure.rescale_intensity(pmap, in_range=in_range)
-    return pmap
+    return in_range
+
+
+def _slices(a):
+    """Iterate over the slices of an array (first axis), or the whole array
+    if it has less than three dimensions.
+    """
+    return iter(a) if a.ndim > 2 else iter([a])
+
+
+def _output(a, out, dtype):
+    """Return output array for a function with `out=` semantics."""
+    if out is None:
+        return np.empty(a.shape, dtype=dtype)
+    if out.shape != a.shape or out.dtype != dtype:
+        raise ValueError('Invalid output array: {}, {}'.format(out.shape,
+                                                               out.dtype))
+    return out
+
+
+def _normalize_slice(a, in_range, out):
+    """Normalize a slice into float32 output, see normalize()."""
+    lo, hi = in_range
+    np.copyto(out, a, casting='unsafe')
+    np.nan_to_num(out, copy=False)
+    np.clip(out, lo, hi, out=out)
+    out -= lo
+    out /= hi - lo
+
 
+def _quantize_slice(a, levels, out, buf):
+    """Quantize a slice using a buffer, see quantize()."""
+    assert np.all(a >= 0) and np.all(a <= 1), (a.min(), a.max())
+    np.multiply(a, levels, out=buf)
+    np.clip(buf, 0, levels - 1, out=buf)
+    np.copyto(out, buf, casting='unsafe')
 
-def quantize(img, levels=32, dtype=np.uint8):
-    """Uniform quantization from float [0, 1] to int [0, levels-1]."""
+
+def normalize(pmap, mode, out=None):
+    """Normalize images within mode-specific range to float32 [0, 1].
+
+    The image is processed slice by slice into `out`, which may be the image
+    itself if it is float32.
+    """
+    in_range = normalize_range(pmap, mode)
+    out = _output(pmap, out, np.float32)
+    for a, o in zip(_slices(pmap), _slices(out)):
+        _normalize_slice(a, in_range, o)
+    return out
+
+
+def quantize(img, levels=32, dtype=np.uint8, out=None):
+    """Uniform quantization from float [0, 1] to int [0, levels-1].
+
+    The image is processed slice by slice into `out`, using a buffer of one
+    slice.
+    """
     img = np.asarray(img)
     assert np.issubsctype(img, np.floating), img.dtype
-    assert np.all(img >= 0) and np.all(img <= 1), (img.min(), img.max())
     # img = skimage.img_as_ubyte(img)
     # img //= int(round(256 / levels))
-    return (img * levels).clip(0, levels - 1).astype(dtype)
+    out = _output(img, out, dtype)
+    buf = None
+    for a, o in zip(_slices(img), _slices(out)):
+        if buf is None:
+            buf = np.empty_like(a)
+        _quantize_slice(a, levels, o, buf)
+    return out
+
+
+def normalize_quantize(pmap, mode, levels=32, dtype=np.uint8, out=None):
+    """Normalize (see normalize()) and quantize (see quantize()) raw images
+    slice by slice into `out`, using a float32 buffer of one slice.
+    """
+    in_range = normalize_range(pmap, mode)
+    out = _output(pmap, out, dtype)
+    buf = None
+    for a, o in zip(_slices(pmap), _slices(out)):
+        if buf is None:
+            buf = np.empty(a.shape, dtype=np.float32)
+        _normalize_slice(a, in_range, buf)
+        _quantize_slice(buf, levels, o, buf)
+    return out
 
 
 def cpu_count():
@@ -363,6 +590,20 @@ def cpu_count():
     return n
 
 
+def job_count(jobs):
+    """Return number of parallel jobs from a specification that is either an
+    absolute number, a portion of CPU count, or a joblib-type negative count
+    (-1 => all, -2 => all but one, etc).
+    """
+    if jobs < 0:
+        n = cpu_count() + jobs + 1
+    elif jobs < 1:
+        n = cpu_count() * jobs
+    else:
+        n = jobs
+    return int(max(1, n))
+
+
 def hostname():
     """Try to return system hostname in a portable fashion."""
     name = platform.uname().node
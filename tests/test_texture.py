@@ -0,0 +1,123 @@
+"""Tests for texture calculation."""
+
+import numpy as np
+import pytest
+import skimage.feature
+
+import dwi
+import dwi.hdf5
+import dwi.texture
+import dwi.texture_skimage
+import dwi.util
+from dwi.types import TextureSpec
+
+MODE = 'DWI-Mono-ADCm'
+needs_greycomatrix = pytest.mark.skipif(
+    not hasattr(skimage.feature, 'greycomatrix'),
+    reason='scikit-image without greycomatrix()')
+
+
+def image(shape=(2, 40, 40), seed=0):
+    """Return a DWI-like image with some NaN voxels, and a mask."""
+    rng = np.random.RandomState(seed)
+    img = (rng.rand(*shape) * 0.003).astype(np.float32)
+    img[0, 2:12, 2:12] = np.nan
+    mask = np.zeros(shape, dtype=bool)
+    mask[:, 4:-4, 4:-4] = True
+    return img, mask
+
+
+def texture(session, method, winspec):
+    """Calculate a texture map of all voxels."""
+    return session.texture(TextureSpec(method, winspec, None), avg=None)
+
+
+def assert_tmaps_equal(a, b):
+    """Assert that texture maps are equal."""
+    assert a[1] == b[1]
+    np.testing.assert_array_equal(np.asarray(a[0]), np.asarray(b[0]))
+
+
+@pytest.mark.parametrize('first, then', [
+    (('haar', '4'), ('stats', '5')),
+    (('haar', '4'), ('gabor', '5')),
+    pytest.param(('glcm_mbb', 'mbb'), ('glcm', '5'),
+                 marks=needs_greycomatrix),
+    ])
+def test_session_methods_independent(first, then):
+    """Methods in a session must not change the image of later methods."""
+    img, mask = image()
+    original = img.copy()
+    session = dwi.texture.TextureSession(img, mask, MODE)
+    texture(session, *first)
+    result = texture(session, *then)
+    np.testing.assert_array_equal(img, original)
+    alone = texture(dwi.texture.TextureSession(img, mask, MODE), *then)
+    assert_tmaps_equal(result, alone)
+
+
+def test_raw_averages():
+    """Raw voxel values are averaged over the mask."""
+    img, mask = image()
+    img[np.isnan(img)] = 0
+    session = dwi.texture.TextureSession(img, mask, MODE)
+    tmaps, names = session.textures([TextureSpec('raw', 1, None)],
+                                    avg=['mean', 'median'])
+    assert names == ['1-raw']
+    np.testing.assert_allclose(tmaps['mean'].ravel(), [img[mask].mean()],
+                               rtol=1e-6)
+    np.testing.assert_allclose(tmaps['median'].ravel(),
+                               [np.median(img[mask])], rtol=1e-6)
+
+
+@pytest.mark.parametrize('method, winspec', [
+    ('haar', '4'),
+    ('stats', '5'),
+    pytest.param('glcm_mbb', 'mbb', marks=needs_greycomatrix),
+    ])
+def test_tiled_processes(monkeypatch, method, winspec):
+    """Tile workers get large inputs as read-only memory maps."""
+    img, mask = image(shape=(4, 300, 300))
+    assert img.nbytes > 2**20
+    monkeypatch.setattr(dwi.rcParams, 'tilesize', 128)
+    monkeypatch.setattr(dwi.rcParams, 'tilejobs', 1)
+    serial = texture(dwi.texture.TextureSession(img, mask, MODE), method,
+                     winspec)
+    monkeypatch.setattr(dwi.rcParams, 'tilejobs', 2)
+    tiled = texture(dwi.texture.TextureSession(img, mask, MODE), method,
+                    winspec)
+    assert_tmaps_equal(tiled, serial)
+
+
+def test_hog_map_nan():
+    """A NaN voxel only affects the windows that contain its gradient."""
+    img = np.random.RandomState(0).rand(30, 30)
+    img[12, 9] = np.nan
+    tmap, _ = dwi.texture_skimage.hog_map(img, 5)
+    windows = dwi.util.window_view(img, (5, 5))
+    expected = np.zeros_like(tmap)
+    expected[(0,) + dwi.util.window_origins(img.shape, (5, 5))] = [
+        [dwi.texture_skimage.hog(x) for x in row] for row in windows]
+    assert np.count_nonzero(np.isnan(tmap)) == 25
+    np.testing.assert_allclose(tmap, expected, rtol=1e-6)
+
+
+def test_textures_on_disk(monkeypatch, tmp_path):
+    """Several voxel maps are merged into one on-disk map."""
+    img, mask = image()
+    tspecs = [TextureSpec('stats', '3', None), TextureSpec('stats', '7', None),
+              TextureSpec('hu', '5', None)]
+    avgs = ['all', 'mean']
+    session = dwi.texture.TextureSession(img, mask, MODE, portion=0.5)
+    expected, names = session.textures(tspecs, avg=avgs)
+    monkeypatch.setattr(dwi.rcParams, 'texture_path', str(tmp_path / 'a.h5'))
+    session = dwi.texture.TextureSession(img, mask, MODE, portion=0.5)
+    tmaps, on_disk_names = session.textures(tspecs, avg=avgs)
+    assert on_disk_names == names
+    dense = tmaps['all']
+    try:
+        assert isinstance(dense, dwi.hdf5.h5py.Dataset)
+        np.testing.assert_array_equal(dense[()], expected['all'])
+    finally:
+        dense.file.close()
+    np.testing.assert_array_equal(tmaps['mean'], expected['mean'])
@@ -0,0 +1,33 @@
+"""Tests for utility functions."""
+
+import numpy as np
+import pytest
+
+import dwi.util
+
+
+@pytest.mark.parametrize('dtype, expected', [
+    (np.bool_, np.int64),
+    (np.uint8, np.int64),
+    (np.int16, np.int64),
+    (np.float32, np.float64),
+    (np.complex64, np.complex128),
+    ])
+def test_sum_dtype(dtype, expected):
+    assert dwi.util.sum_dtype(dtype) == expected
+
+
+def test_window_sums_uint8():
+    """Sums of quantized images must not wrap around."""
+    a = np.full((6, 7), 255, dtype=np.uint8)
+    sums = dwi.util.window_sums(a, (3, 3))
+    assert sums.dtype == np.int64
+    assert sums.shape == (4, 5)
+    np.testing.assert_array_equal(sums, 9 * 255)
+
+
+def test_window_sums():
+    a = np.random.RandomState(0).rand(5, 6, 7)
+    sums = dwi.util.window_sums(a, (2, 3, 4))
+    windows = dwi.util.window_view(a, (2, 3, 4))
+    np.testing.assert_allclose(sums, windows.sum(axis=(-3, -2, -1)))